@@ -5,44 +5,89 @@ from IPython.display import Markdown
 from fpdf import FPDF
 from docx import Document
 import os
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from chromadb.config import DEFAULT_TENANT, DEFAULT_DATABASE, Settings
-from chromadb import Client, PersistentClient
-from chromadb.utils import embedding_functions
-from langchain_community.document_loaders import PyPDFLoader
-from langchain.text_splitter import SentenceTransformersTokenTextSplitter
+import hashlib
+import numpy as np
+from text_extractors import load_pages
+from ingest_workers import extract_and_chunk, iter_char_chunks
+from embedding_models import SharedEmbeddingFunction, get_embedding_model, embed_texts
+import chroma_store
+import query_cache
+import lexical_index
+
+# Fuse BM25 results of the collection's lexical index with the vector results
+HYBRID_RETRIEVAL = os.getenv('HYBRID_RETRIEVAL', '1') == '1'
+# doc_hash of the chunks of a document whose streamed ingestion has not finished yet
+PENDING_DOC_HASH = ''
 
 class RetrieveDocuments:
-    def __init__(self, chromadb_path, collection_name, model_name):
-        """Initialize RetrieveDocuments with ChromaDB configuration"""
-        self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name=model_name
-        )
-        self.chroma_client = PersistentClient(
-            path=chromadb_path,
-            settings=Settings(),
-            tenant=DEFAULT_TENANT,
-            database=DEFAULT_DATABASE
-        )
-        self.chroma_collection = self.chroma_client.get_or_create_collection(
-            collection_name,
-            embedding_function=self.embedding_function
-        )
+    def __init__(self, chromadb_path, collection_name, model_name, cache_results=True, hybrid=None):
+        """Initialize RetrieveDocuments with ChromaDB configuration.
+        With cache_results, results of repeated queries are served from memory until the collection changes.
+        With hybrid (HYBRID_RETRIEVAL by default), vector and BM25 results are fused."""
+        self.chromadb_path = chromadb_path
+        self.collection_name = collection_name
+        self.model_name = model_name
+        self.cache_results = cache_results
+        self.hybrid = HYBRID_RETRIEVAL if hybrid is None else hybrid
+        self.lexical_index = lexical_index.get_index(chromadb_path, collection_name) if self.hybrid else None
+        self.embedding_function = SharedEmbeddingFunction(model_name)
+        self.chroma_client = chroma_store.get_client(chromadb_path)
+        self.chroma_collection = chroma_store.get_collection(chromadb_path, collection_name, self.embedding_function)
 
-    def retrieve_documents(self, query, n_results=5, return_only_docs=False):
-        try:
-            print(f"Querying collection with: {query}")
-            results = self.chroma_collection.query(
-                query_texts=[query],
+    def embed_queries(self, queries):
+        """Embed query texts in one call, recently asked queries come from the in-process LRU"""
+        embeddings = [query_cache.query_embeddings.get((self.model_name, query)) for query in queries]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            vectors = self.embedding_function([queries[i] for i in missing])
+            for i, vector in zip(missing, vectors):
+                embeddings[i] = vector
+                query_cache.query_embeddings.put((self.model_name, queries[i]), vector)
+        return embeddings
+
+    def query_collection(self, query_embeddings, n_results=5):
+        """Probe the collection with embedded queries in one call.
+        Returns one {'ids', 'documents', 'metadatas', 'distances'} dict per query."""
+        # Read the version before querying, a write racing with the query then invalidates its result
+        version = query_cache.collection_version(self.chromadb_path, self.collection_name)
+        collection_key = query_cache.collection_key(self.chromadb_path, self.collection_name)
+        keys = [
+            (collection_key, version, query_cache.vector_hash(embedding), n_results)
+            for embedding in query_embeddings
+        ]
+        results = [query_cache.query_results.get(key) if self.cache_results else None for key in keys]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            raw_results = self.chroma_collection.query(
+                query_embeddings=[query_embeddings[i] for i in missing],
                 include=["documents", "metadatas", "distances"],
                 n_results=n_results
             )
-            
-            if results['documents'] and results['documents'][0]:
-                print(f"Found {len(results['documents'][0])} matching documents")
+            for position, i in enumerate(missing):
+                results[i] = {
+                    field: (raw_results[field] or [[]] * len(missing))[position]
+                    for field in ('ids', 'documents', 'metadatas', 'distances')
+                }
+                if self.cache_results:
+                    query_cache.query_results.put(keys[i], results[i])
+        return results
+
+    def retrieve_documents(self, query, n_results=5, return_only_docs=False):
+        try:
+            print(f"Querying collection with: {query}")
+            query_embedding = self.embed_queries([query])[0]
+            if self.use_hybrid():
+                results = self.hybrid_search(query, query_embedding, n_results)
+            else:
+                results = self.query_collection([query_embedding], n_results)[0]
+
+            if results['documents']:
+                print(f"Found {len(results['documents'])} matching documents")
+                # A copy, so callers cannot alter the cached result
                 if return_only_docs:
-                    return results['documents'][0]
-                return results['documents'][0]  # Return just the documents list
+                    return list(results['documents'])
+                return list(results['documents'])  # Return just the documents list
             else:
                 print("No matching documents found")
                 return [] if return_only_docs else []
@@ -51,80 +96,402 @@ class RetrieveDocuments:
             print(f"Error during document retrieval: {str(e)}")
             return [] if return_only_docs else []
 
+    def use_hybrid(self):
+        """Whether to fuse BM25 results: only once the lexical index covers the whole collection,
+        collections indexed before it existed are backfilled by ChromaDBManager"""
+        return self.lexical_index is not None and len(self.lexical_index) >= self.chroma_collection.count()
+
+    @staticmethod
+    def hybrid_candidates(n_results):
+        """Number of chunks each of the vector and BM25 rankings contributes to the fusion"""
+        return max(4 * n_results, 20)
+
+    def hybrid_search(self, query, query_embedding, n_results=5, candidates=None, vector_results=None):
+        """Fuse the vector and BM25 rankings of ``candidates`` chunks each with reciprocal-rank fusion (k=60).
+        Returns the top n_results like query_collection, the distance of a chunk only BM25 found is None.
+        Pass the query_collection result of ``candidates`` chunks as ``vector_results`` when the
+        collection was already probed."""
+        candidates = candidates or self.hybrid_candidates(n_results)
+        # Read the version before searching, like query_collection
+        version = query_cache.collection_version(self.chromadb_path, self.collection_name)
+        key = (query_cache.collection_key(self.chromadb_path, self.collection_name), version,
+               query_cache.vector_hash(query_embedding), n_results, 'hybrid', candidates, query)
+        if self.cache_results:
+            cached = query_cache.query_results.get(key)
+            if cached is not None:
+                return cached
+
+        if vector_results is None:
+            vector_results = self.query_collection([query_embedding], candidates)[0]
+        lexical_ids = [chunk_id for chunk_id, _ in self.lexical_index.search(query, candidates)]
+        fused_ids = lexical_index.reciprocal_rank_fusion([vector_results['ids'], lexical_ids])[:n_results]
+
+        chunks = {
+            chunk_id: (document, metadata, distance)
+            for chunk_id, document, metadata, distance in zip(
+                vector_results['ids'], vector_results['documents'], vector_results['metadatas'], vector_results['distances']
+            )
+        }
+        missing_ids = [chunk_id for chunk_id in fused_ids if chunk_id not in chunks]
+        if missing_ids:
+            lexical_results = self.chroma_collection.get(ids=missing_ids, include=['documents', 'metadatas'])
+            for chunk_id, document, metadata in zip(lexical_results['ids'], lexical_results['documents'], lexical_results['metadatas']):
+                chunks[chunk_id] = (document, metadata, None)
+
+        # Chunks deleted from the collection by another process may linger in the lexical index
+        fused_ids = [chunk_id for chunk_id in fused_ids if chunk_id in chunks]
+        results = {
+            'ids': fused_ids,
+            'documents': [chunks[chunk_id][0] for chunk_id in fused_ids],
+            'metadatas': [chunks[chunk_id][1] for chunk_id in fused_ids],
+            'distances': [chunks[chunk_id][2] for chunk_id in fused_ids],
+        }
+        if self.cache_results:
+            query_cache.query_results.put(key, results)
+        return results
+
+    def retrieve_many(self, queries, n_results=5, merge=False):
+        """Retrieve documents for several queries with one embedding pass and one index probe.
+        Returns one {'query', 'documents', 'metadatas', 'distances'} dict per query, or with merge a
+        single list of {'document', 'metadata', 'distance', 'queries'} dicts ranked by distance where
+        a document found by several queries appears once with its best distance.
+        When the collection has a lexical index each query is fused with its BM25 results like in
+        retrieve_documents; chunks only BM25 found have no distance, and merged results are then
+        ranked by reciprocal-rank fusion of the per-query rankings."""
+        queries = list(queries)
+        if not queries:
+            return []
+        try:
+            print(f"Querying collection with {len(queries)} queries")
+            query_embeddings = self.embed_queries(queries)
+            hybrid = self.use_hybrid()
+            if hybrid:
+                candidates = self.hybrid_candidates(n_results)
+                results = [
+                    self.hybrid_search(query, query_embedding, n_results, candidates, vector_results)
+                    for query, query_embedding, vector_results in zip(
+                        queries, query_embeddings, self.query_collection(query_embeddings, candidates)
+                    )
+                ]
+            else:
+                results = self.query_collection(query_embeddings, n_results)
+        except Exception as e:
+            print(f"Error during document retrieval: {str(e)}")
+            return []
+
+        per_query = [
+            {
+                'query': query,
+                'documents': list(result['documents']),
+                'metadatas': list(result['metadatas']),
+                'distances': list(result['distances'])
+            }
+            for query, result in zip(queries, results)
+        ]
+        if not merge:
+            return per_query
+
+        merged = {}
+        for result in per_query:
+            for document, metadata, distance in zip(result['documents'], result['metadatas'], result['distances']):
+                entry = merged.get(document)
+                if entry is None:
+                    merged[document] = {'document': document, 'metadata': metadata, 'distance': distance, 'queries': [result['query']]}
+                else:
+                    # Chunks repeating the same text have distinct IDs, a query can find the text twice
+                    if result['query'] not in entry['queries']:
+                        entry['queries'].append(result['query'])
+                    if distance is not None and (entry['distance'] is None or distance < entry['distance']):
+                        entry['metadata'], entry['distance'] = metadata, distance
+        if hybrid:
+            ranking = lexical_index.reciprocal_rank_fusion(dict.fromkeys(result['documents']) for result in per_query)
+            return [merged[document] for document in ranking]
+        return sorted(merged.values(), key=lambda entry: entry['distance'])
+
 class ChromaDBManager:
     def __init__(self, chromaDB_path, collection_name, model_name):
         self.chromaDB_path = chromaDB_path
         self.collection_name = collection_name
         self.model_name = model_name
-        self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name=self.model_name
-        )
+        self.embedding_function = SharedEmbeddingFunction(self.model_name)
         self.chroma_client, self.chroma_collection = self.create_chroma_client()
+        # BM25 index kept next to the collection for hybrid retrieval, None for in-memory collections
+        self.lexical_index = lexical_index.get_index(chromaDB_path, collection_name)
+        self._backfill_lexical_index()
+        # Collections indexed before chunk IDs were content hashes hold chunks "0".."N" without a
+        # source, which are never matched to an upload nor deleted with it
+        if self.chroma_collection.get(ids=['0'], include=[])['ids']:
+            print(f"Collection {collection_name} has chunks indexed without a source document, "
+                  f"re-create it to avoid duplicate chunks")
 
-    def create_chroma_client(self):
-        if self.chromaDB_path is not None:
-            chroma_client = PersistentClient(
-                path=self.chromaDB_path,
-                settings=Settings(),
-                tenant=DEFAULT_TENANT,
-                database=DEFAULT_DATABASE
-            )
-        else:
-            chroma_client = Client()
+    def _backfill_lexical_index(self, batch_size=5000):
+        """Index the chunks stored before the lexical index existed, retrieval only fuses BM25
+        results once the index covers the whole collection"""
+        if self.lexical_index is None or len(self.lexical_index) >= self.chroma_collection.count():
+            return
+        print(f"Building the lexical index of collection {self.collection_name}")
+        for offset in range(0, self.chroma_collection.count(), batch_size):
+            result = self.chroma_collection.get(include=['documents'], limit=batch_size, offset=offset)
+            # Chunks already indexed are skipped by add
+            self.lexical_index.add(result['ids'], result['documents'])
+        self._collection_changed()
 
-        chroma_collection = chroma_client.get_or_create_collection(
-            self.collection_name,
-            embedding_function=self.embedding_function
-        )
+    def _collection_changed(self):
+        # Cached query results of this collection are stale now
+        query_cache.invalidate_collection(self.chromaDB_path, self.collection_name)
+
+    def create_chroma_client(self):
+        # Clients and collection handles are shared process-wide, see chroma_store
+        chroma_client = chroma_store.get_client(self.chromaDB_path)
+        chroma_collection = chroma_store.get_collection(self.chromaDB_path, self.collection_name, self.embedding_function)
 
         return chroma_client, chroma_collection
 
     def add_document_to_collection(self, ids, metadatas, text_chunksinTokens):
         print("Before inserting, the size of the collection: ", self.chroma_collection.count())
-        self.chroma_collection.add(ids=ids, metadatas=metadatas, documents=text_chunksinTokens)
+        # Embeddings are computed here in explicit batches rather than by the collection
+        embeddings = embed_texts(self.model_name, text_chunksinTokens)
+        self.chroma_collection.add(ids=ids, metadatas=metadatas, documents=text_chunksinTokens, embeddings=embeddings)
+        if self.lexical_index is not None:
+            self.lexical_index.add(ids, text_chunksinTokens)
+        self._collection_changed()
         print("After inserting, the size of the collection: ", self.chroma_collection.count())
         return self.chroma_collection
 
-class TextProcessor:
+    def get_document_hash(self, source):
+        """Return the doc_hash the chunks of a source document were indexed with, None if it is not
+        indexed or its last indexing did not finish: then its chunks do not all carry the same hash,
+        some still have the hash of the previous version or the pending one of add_document_batches"""
+        result = self.chroma_collection.get(where={'source': source}, include=['metadatas'])
+        doc_hashes = {metadata.get('doc_hash') for metadata in result['metadatas']}
+        if len(doc_hashes) != 1:
+            return None
+        doc_hash = doc_hashes.pop()
+        return doc_hash if doc_hash != PENDING_DOC_HASH else None
+
+    def _set_document_hash(self, ids, doc_hash, batch_size=500):
+        """Set the doc_hash of indexed chunks, without embedding them again"""
+        for start in range(0, len(ids), batch_size):
+            result = self.chroma_collection.get(ids=ids[start:start + batch_size], include=['metadatas'])
+            self.chroma_collection.update(
+                ids=result['ids'],
+                metadatas=[dict(metadata, doc_hash=doc_hash) for metadata in result['metadatas']]
+            )
+        self._collection_changed()
+
+    def _write_chunks(self, ids, metadatas, text_chunksinTokens, existing_ids):
+        """Embed and add the chunks whose IDs are not indexed yet, only refresh the metadata of the others"""
+        new = [i for i, chunk_id in enumerate(ids) if chunk_id not in existing_ids]
+        kept = [i for i, chunk_id in enumerate(ids) if chunk_id in existing_ids]
+        if new:
+            documents = [text_chunksinTokens[i] for i in new]
+            self.chroma_collection.add(
+                ids=[ids[i] for i in new],
+                metadatas=[metadatas[i] for i in new],
+                documents=documents,
+                embeddings=embed_texts(self.model_name, documents)
+            )
+            if self.lexical_index is not None:
+                self.lexical_index.add([ids[i] for i in new], documents)
+        if kept:
+            self.chroma_collection.update(ids=[ids[i] for i in kept], metadatas=[metadatas[i] for i in kept])
+        self._collection_changed()
+        return len(new)
+
+    def _delete_chunks(self, ids):
+        self.chroma_collection.delete(ids=ids)
+        if self.lexical_index is not None:
+            self.lexical_index.delete(ids)
+        self._collection_changed()
+
+    def upsert_document(self, source, doc_hash, text_chunksinTokens, metadatas):
+        """Index the chunks of a source document idempotently.
+        Chunk IDs are content hashes, so chunks already in the collection are not embedded again and
+        chunks of a previous version of the document that are gone are deleted. Returns the number
+        of chunks that had to be embedded."""
+        ids = TextProcessor.content_ids(text_chunksinTokens, source)
+        metadatas = [dict(metadata, source=source, doc_hash=doc_hash) for metadata in metadatas]
+        existing_ids = set(self.chroma_collection.get(where={'source': source}, include=[])['ids'])
+
+        embedded = self._write_chunks(ids, metadatas, text_chunksinTokens, existing_ids)
+        stale_ids = list(existing_ids - set(ids))
+        if stale_ids:
+            self._delete_chunks(stale_ids)
+        print(f"Indexed {source}: {embedded} new, {len(ids) - embedded} unchanged, {len(stale_ids)} removed chunks")
+        return embedded
+
+    def add_document_batches(self, batches, title, category, source, doc_hash):
+        """Upsert batches of (token chunk, page number) pairs of a source document as they are produced,
+        like upsert_document. Chunks are stored with a pending doc_hash that is only set to ``doc_hash``
+        once every batch is stored, so an interrupted ingestion is not taken for a complete one.
+        Returns the number of chunks."""
+        existing_ids = set(self.chroma_collection.get(where={'source': source}, include=[])['ids'])
+        seen_ids, occurrences = set(), {}
+        for batch in batches:
+            text_chunksinTokens = [text for text, _ in batch]
+            ids = TextProcessor.content_ids(text_chunksinTokens, source, occurrences)
+            metadatas = [
+                {'document': title, 'category': category, 'page': page_number, 'source': source, 'doc_hash': PENDING_DOC_HASH}
+                for _, page_number in batch
+            ]
+            self._write_chunks(ids, metadatas, text_chunksinTokens, existing_ids)
+            seen_ids.update(ids)
+
+        stale_ids = list(existing_ids - seen_ids)
+        if stale_ids:
+            self._delete_chunks(stale_ids)
+        self._set_document_hash(list(seen_ids), doc_hash)
+        print("After inserting, the size of the collection: ", self.chroma_collection.count())
+        return len(seen_ids)
+
+class TokenSplitter:
+    """
+    Splits texts into windows of ``tokens_per_chunk`` tokens overlapping by ``chunk_overlap``,
+    with the same output as LangChain's SentenceTransformersTokenTextSplitter. The tokenizer is
+    the one of the shared registry model, and a whole batch of texts is tokenized in one call.
+    """
+
+    def __init__(self, model_name, chunk_overlap=0, tokens_per_chunk=128):
+        if chunk_overlap >= tokens_per_chunk:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than tokens_per_chunk ({tokens_per_chunk})")
+        self.tokenizer, max_seq_length = self.get_tokenizer(model_name)
+        if tokens_per_chunk > max_seq_length:
+            raise ValueError(
+                f"The token limit of the model '{model_name}' is: {max_seq_length}. "
+                f"Argument tokens_per_chunk={tokens_per_chunk} > maximum token limit."
+            )
+        self.chunk_overlap = chunk_overlap
+        self.tokens_per_chunk = tokens_per_chunk
+
     @staticmethod
-    def convert_page_chunk_in_char(pdf_file, chunk_size=1500, chunk_overlap=0):
-        loader = PyPDFLoader(pdf_file)
-        pdf_texts = loader.load()
-
-        character_splitter = RecursiveCharacterTextSplitter(
-            separators=["\n\n", "\n", ". ", " ", ""],
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap
+    def get_tokenizer(model_name):
+        """Return the (tokenizer, max sequence length) of a sentence-transformers model"""
+        model = get_embedding_model(model_name)
+        return model.tokenizer, model.max_seq_length
+
+    def split_texts(self, texts):
+        """Split every text into token chunks, returns one list of chunks per text"""
+        texts = list(texts)
+        if not texts:
+            return []
+        input_ids = self.tokenizer(
+            texts, add_special_tokens=False, truncation=False, verbose=False, return_attention_mask=False
+        )['input_ids']
+        lengths = np.fromiter((len(ids) for ids in input_ids), dtype=np.int64, count=len(input_ids))
+        flat_ids = np.fromiter((token for ids in input_ids for token in ids), dtype=np.int64, count=int(lengths.sum()))
+        text_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+
+        # Windows start every (tokens_per_chunk - overlap) tokens, the last one reaches the end of the text
+        step = self.tokens_per_chunk - self.chunk_overlap
+        window_counts = np.where(
+            lengths > self.tokens_per_chunk, -(-(lengths - self.tokens_per_chunk) // step) + 1, np.minimum(lengths, 1)
         )
+        owners = np.repeat(np.arange(len(texts)), window_counts)
+        first_window = np.concatenate(([0], np.cumsum(window_counts)[:-1]))
+        offsets = (np.arange(len(owners)) - first_window[owners]) * step
+        starts = text_starts[owners] + offsets
+        stops = text_starts[owners] + np.minimum(offsets + self.tokens_per_chunk, lengths[owners])
 
-        pdf_text_content = '\n\n'.join([doc.page_content for doc in pdf_texts])
-        character_split_texts = character_splitter.split_text(pdf_text_content)
+        chunks = self.tokenizer.batch_decode([flat_ids[start:stop].tolist() for start, stop in zip(starts, stops)])
+        splits = [[] for _ in texts]
+        for owner, chunk in zip(owners.tolist(), chunks):
+            splits[owner].append(chunk)
+        return splits
 
-        print(f"\nTotal number of chunks (document split by max char = {chunk_size}): {len(character_split_texts)}")
-        return character_split_texts
+
+class TextProcessor:
+    @staticmethod
+    def load_pages(file_path, pdf_backend=None):
+        """Yield (page number, text) pairs of a document, see text_extractors.load_pages"""
+        return load_pages(file_path, pdf_backend)
+
+    @staticmethod
+    def convert_page_chunk_in_char(pdf_file, chunk_size=1500, chunk_overlap=0, pdf_backend=None):
+        return [chunk for chunk, _ in extract_and_chunk(pdf_file, chunk_size, chunk_overlap, pdf_backend)]
 
     @staticmethod
     def convert_chunk_token(text_chunksinChar, sentence_transformer_model, chunk_overlap=0, tokens_per_chunk=128):
-        token_splitter = SentenceTransformersTokenTextSplitter(
-            chunk_overlap=chunk_overlap,
-            model_name=sentence_transformer_model,
-            tokens_per_chunk=tokens_per_chunk
-        )
+        token_splitter = TokenSplitter(sentence_transformer_model, chunk_overlap, tokens_per_chunk)
 
         text_chunksinTokens = []
-        for text in text_chunksinChar:
-            text_chunksinTokens += token_splitter.split_text(text)
+        for splits in token_splitter.split_texts(text_chunksinChar):
+            text_chunksinTokens += splits
         print(f"\nTotal number of chunks (document split by 128 tokens per chunk): {len(text_chunksinTokens)}")
         return text_chunksinTokens
 
     @staticmethod
-    def add_meta_data(text_chunksinTokens, title, category, initial_id):
+    def iter_char_chunks(pages, chunk_size=1500, chunk_overlap=0, window_chunks=8):
+        """Split a stream of (page number, text) pairs into (chunk, page number) pairs, see ingest_workers.iter_char_chunks"""
+        return iter_char_chunks(pages, chunk_size, chunk_overlap, window_chunks)
+
+    @staticmethod
+    def iter_token_chunks(char_chunks, sentence_transformer_model, chunk_overlap=0, tokens_per_chunk=128,
+                          batch_size=64):
+        """Split (chunk, page number) pairs from iter_char_chunks into token chunks lazily,
+        tokenizing ``batch_size`` character chunks at a time"""
+        token_splitter = TokenSplitter(sentence_transformer_model, chunk_overlap, tokens_per_chunk)
+        for batch in TextProcessor.iter_batches(char_chunks, batch_size):
+            for (_, page_number), splits in zip(batch, token_splitter.split_texts(text for text, _ in batch)):
+                for token_chunk in splits:
+                    yield token_chunk, page_number
+
+    @staticmethod
+    def iter_batches(items, batch_size=64):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def iter_document_batches(file_path, sentence_transformer_model, chunk_size=1500, chunk_overlap=0,
+                              batch_size=64, pdf_backend=None):
+        """Stream a document as batches of (token chunk, page number) pairs.
+        Peak memory is bounded by chunk and batch size rather than by the document size."""
+        pages = TextProcessor.load_pages(file_path, pdf_backend)
+        char_chunks = TextProcessor.iter_char_chunks(pages, chunk_size, chunk_overlap)
+        token_chunks = TextProcessor.iter_token_chunks(char_chunks, sentence_transformer_model)
+        return TextProcessor.iter_batches(token_chunks, batch_size)
+
+    @staticmethod
+    def document_hash(file_path, *settings):
+        """Hash of a file's bytes and of the settings (model, chunk sizes) its chunks are produced with"""
+        digest = hashlib.sha256()
+        for value in settings:
+            digest.update(f"{value}\0".encode('utf-8'))
+        with open(file_path, 'rb') as document_file:
+            for block in iter(lambda: document_file.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def content_ids(text_chunksinTokens, source, occurrences=None):
+        """Stable chunk IDs hashed from the source document, the chunk text and the number of times the
+        same text occurred before in the document. Pass the same ``occurrences`` dict across batches
+        of one document."""
+        occurrences = {} if occurrences is None else occurrences
+        ids = []
+        for text in text_chunksinTokens:
+            text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            occurrence = occurrences.get(text_hash, 0)
+            occurrences[text_hash] = occurrence + 1
+            ids.append(hashlib.sha256(f"{source}\0{text_hash}\0{occurrence}".encode('utf-8')).hexdigest()[:32])
+        return ids
+
+    @staticmethod
+    def add_meta_data(text_chunksinTokens, title, category, initial_id, page_numbers=None):
         ids = [str(i + initial_id) for i in range(len(text_chunksinTokens))]
         metadata = {
             'document': title,
             'category': category
         }
-        metadatas = [metadata for _ in range(len(text_chunksinTokens))]
+        if page_numbers is None:
+            metadatas = [metadata for _ in range(len(text_chunksinTokens))]
+        else:
+            metadatas = [dict(metadata, page=page_number) for page_number in page_numbers]
         return ids, metadatas
 
 class GeminiManager:
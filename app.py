@@ -1,4 +1,5 @@
 from gc import collect
+from contextlib import closing
 import json
 import streamlit as st
 import mysql.connector
@@ -9,13 +10,15 @@ from dotenv import load_dotenv
 import ChatBotAgent
 from RAG import ChromaDBManager, RetrieveDocuments, TextProcessor
 from StudyAgent import StudyAgent
-from lms_access import ContentProcessor
+from lms_access import ContentProcessor, ACTIVE_GENERATION_SQL
+from ingest_workers import chunk_files, get_shared_pool
+from text_extractors import pdf_page_count
+from embedding_models import ingest_batch_size
 import time
 from ReminderAgent import ReminderAgent
 from ChatBotAgent import ChatBotAgent
 import chromadb
-from chromadb.config import Settings
-from chromadb import PersistentClient
+import chroma_store
 
 # Load environment variables
 load_dotenv()
@@ -38,8 +41,13 @@ def process_lms_content(user_id, moodle_key, moodle_id):
         if not moodle_key or not user_id or not moodle_id:
             return False, f"Missing values - Token: {bool(moodle_key)}, User ID: {bool(user_id)}, Moodle ID: {bool(moodle_id)}"
         
-        # Populate database with course content
-        processor.populate_database()
+        # Populate database with course content under a new generation that replaces the current one once
+        # complete; finished courses and forums are checkpointed, so a sync interrupted by a restart
+        # continues where it stopped on the next click
+        failures = processor.populate_database(atomic=True)
+        if failures:
+            return True, (f"LMS content processed, {len(failures)} course or forum fetches failed "
+                          f"and their courses keep their previous content")
         
         return True, "LMS content processed successfully!"
     except Exception as e:
@@ -81,14 +89,7 @@ def get_db_connection():
 def get_available_collections():
     """Get list of available ChromaDB collections"""
     try:
-        client = PersistentClient(
-            path='./ChromaDbPersistent',
-            settings=Settings(),
-            tenant="default_tenant",
-            database="default_database"
-        )
-        collections = client.list_collections()
-        return [collection.name for collection in collections]
+        return chroma_store.list_collection_names('./ChromaDbPersistent')
     except Exception as e:
         print(f"Error fetching collections: {str(e)}")
         return []
@@ -168,8 +169,9 @@ def display_course_content(course_id, course_name):
         cursor.execute("""
             SELECT DISTINCT pdf_url 
             FROM pdf_urls 
-            WHERE course_id = %s AND user_id = %s
-        """, (course_id, st.session_state.user_id))
+            WHERE course_id = %s AND user_id = %s AND generation = {ACTIVE_GENERATION}
+        """.format(ACTIVE_GENERATION=ACTIVE_GENERATION_SQL),
+        (course_id, st.session_state.user_id, st.session_state.user_id))
         pdfs = cursor.fetchall()
         
         if pdfs:
@@ -198,12 +200,12 @@ def display_course_list():
             SELECT DISTINCT c.course_id, c.course_name 
             FROM courses c
             INNER JOIN (
-                SELECT course_id FROM pdf_urls WHERE user_id = %s
+                SELECT course_id FROM pdf_urls WHERE user_id = %s AND generation = {ACTIVE_GENERATION}
                 UNION
-                SELECT course_id FROM discussion_urls WHERE user_id = %s
+                SELECT course_id FROM discussion_urls WHERE user_id = %s AND generation = {ACTIVE_GENERATION}
                 ) AS user_courses ON c.course_id = user_courses.course_id
                 ORDER BY c.course_name
-        """, (st.session_state.user_id, st.session_state.user_id))
+        """.format(ACTIVE_GENERATION=ACTIVE_GENERATION_SQL), (st.session_state.user_id,) * 4)
         
         courses = cursor.fetchall()
         
@@ -646,22 +648,78 @@ def process_uploaded_files(uploaded_files, collection_name):
         os.makedirs(upload_dir)
 
     try:
+        file_paths = {}
         for uploaded_file in uploaded_files:
             file_path = os.path.join(upload_dir, uploaded_file.name)
 
             with open(file_path, "wb") as f:
                 f.write(uploaded_file.getbuffer())
+            file_paths[file_path] = uploaded_file.name
+
+        chunk_size = 1500
+        chunk_overlap = 0
+        # One manager for the whole upload, its embedding model is shared process-wide
+        chroma_manager = ChromaDBManager(chromaDB_path, collection_name, sentence_transformer_model)
+        text_processor = TextProcessor()
+
+        # Files indexed before with the same content and settings are skipped without being read again
+        doc_hashes = {}
+        for file_path, file_name in list(file_paths.items()):
+            doc_hash = TextProcessor.document_hash(file_path, sentence_transformer_model, chunk_size, chunk_overlap)
+            if chroma_manager.get_document_hash(file_name) == doc_hash:
+                st.info(f"File unchanged, skipped: {file_name}")
+                del file_paths[file_path]
+            else:
+                doc_hashes[file_path] = doc_hash
+
+        # Very large documents are streamed page by page so only a small window of text is in memory.
+        # Text grows with pages rather than bytes, a 1,000-page lecture PDF can weigh only a few MB
+        streaming_min_bytes = int(os.getenv('STREAMING_INGEST_MIN_BYTES', str(50 * 1024 * 1024)))
+        streaming_min_pages = int(os.getenv('STREAMING_INGEST_MIN_PAGES', '300'))
+        large_files = []
+        for file_path in list(file_paths):
+            try:
+                if (os.path.getsize(file_path) >= streaming_min_bytes
+                        or (file_path.lower().endswith('.pdf') and pdf_page_count(file_path) >= streaming_min_pages)):
+                    large_files.append(file_path)
+            except Exception as e:
+                st.error(f"Error processing file {file_paths[file_path]}: {str(e)}")
+                del file_paths[file_path]
+        for file_path in large_files:
+            try:
+                batches = TextProcessor.iter_document_batches(file_path, sentence_transformer_model, chunk_size,
+                                                              chunk_overlap, batch_size=ingest_batch_size())
+                chroma_manager.add_document_batches(batches, title="LMS_Content", category="PDF",
+                                                    source=file_paths[file_path], doc_hash=doc_hashes[file_path])
+            except Exception as e:
+                st.error(f"Error processing file {file_paths[file_path]}: {str(e)}")
+                continue
+            st.success(f"Processed file: {file_paths[file_path]}")
+
+        # Extraction and character chunking of the other files run in parallel worker processes,
+        # files are indexed in the order they finish
+        small_files = [file_path for file_path in file_paths if file_path not in large_files]
+        # The pool's workers stay up for the next upload. Closed explicitly so workers still busy are
+        # stopped when indexing is interrupted
+        with closing(chunk_files(small_files, chunk_size, chunk_overlap, pool=get_shared_pool())) as chunked_files:
+            for file_path, char_chunks in chunked_files:
+                if isinstance(char_chunks, Exception):
+                    st.error(f"Error processing file {file_paths[file_path]}: {str(char_chunks)}")
+                    continue
 
-            chroma_manager = ChromaDBManager(chromaDB_path, collection_name, sentence_transformer_model)
-            text_processor = TextProcessor()
-
-            chunk_size = 1500
-            chunk_overlap = 0
-            text_chunksinChar = text_processor.convert_page_chunk_in_char(file_path, chunk_size, chunk_overlap)
-            text_chunksinTokens = text_processor.convert_chunk_token(text_chunksinChar, sentence_transformer_model)
-            ids, metadatas = text_processor.add_meta_data(text_chunksinTokens, title="LMS_Content", category="PDF", initial_id=0)
-            chroma_manager.add_document_to_collection(ids, metadatas, text_chunksinTokens)
-            st.success(f"Processed file: {uploaded_file.name}")
+                try:
+                    # Token chunks keep the page their character chunk starts on, like streamed files
+                    token_chunks = list(text_processor.iter_token_chunks(char_chunks, sentence_transformer_model))
+                    text_chunksinTokens = [text for text, _ in token_chunks]
+                    _, metadatas = text_processor.add_meta_data(
+                        text_chunksinTokens, title="LMS_Content", category="PDF", initial_id=0,
+                        page_numbers=[page_number for _, page_number in token_chunks]
+                    )
+                    chroma_manager.upsert_document(file_paths[file_path], doc_hashes[file_path], text_chunksinTokens, metadatas)
+                except Exception as e:
+                    st.error(f"Error processing file {file_paths[file_path]}: {str(e)}")
+                    continue
+                st.success(f"Processed file: {file_paths[file_path]}")
     except Exception as e:
         st.error(f"Error processing files: {str(e)}")
 
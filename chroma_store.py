@@ -0,0 +1,99 @@
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+from chromadb import Client, PersistentClient
+from chromadb.config import DEFAULT_TENANT, DEFAULT_DATABASE, Settings
+import query_cache
+import lexical_index
+
+# Open handles shared by the whole process. Streamlit reruns the script on every interaction but
+# imports modules once, so these survive reruns and the store is not reopened on every page view.
+_clients: Dict[Optional[str], object] = {}
+_collections: Dict[Tuple[Optional[str], str, Optional[str]], object] = {}
+_collection_names: Dict[Optional[str], List[str]] = {}
+_lock = threading.RLock()
+
+
+def _path_key(path: Optional[str]) -> Optional[str]:
+    return os.path.abspath(path) if path is not None else None
+
+
+def get_client(path: Optional[str] = None):
+    """Return the shared client of a ChromaDB directory, an in-memory client when path is None"""
+    key = _path_key(path)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            if key is None:
+                client = Client()
+            else:
+                client = PersistentClient(
+                    path=key,
+                    settings=Settings(),
+                    tenant=DEFAULT_TENANT,
+                    database=DEFAULT_DATABASE
+                )
+            _clients[key] = client
+        return client
+
+
+def get_collection(path: Optional[str], name: str, embedding_function=None, create: bool = True):
+    """Return a cached handle of a collection, created if it does not exist and ``create`` is set.
+    Handles are cached per embedding model, so callers embedding with different models do not share one."""
+    model_name = getattr(embedding_function, 'model_name', None)
+    key = (_path_key(path), name, model_name)
+    with _lock:
+        collection = _collections.get(key)
+        if collection is not None:
+            return collection
+
+        client = get_client(path)
+        kwargs = {'embedding_function': embedding_function} if embedding_function is not None else {}
+        if create:
+            collection = client.get_or_create_collection(name, **kwargs)
+            names = _collection_names.get(key[0])
+            if names is not None and name not in names:
+                # A new collection was created, the cached listing is stale
+                _collection_names.pop(key[0], None)
+        else:
+            collection = client.get_collection(name, **kwargs)
+        _collections[key] = collection
+        return collection
+
+
+def delete_collection(path: Optional[str], name: str):
+    """Delete a collection and drop every cached handle of it"""
+    with _lock:
+        get_client(path).delete_collection(name)
+        invalidate(path, name)
+        query_cache.invalidate_collection(path, name)
+        lexical_index.drop_index(path, name)
+
+
+def list_collection_names(path: Optional[str] = None) -> List[str]:
+    """Names of the collections of a ChromaDB directory, listed once and then served from the cache"""
+    key = _path_key(path)
+    with _lock:
+        names = _collection_names.get(key)
+        if names is None:
+            # list_collections returns names in recent ChromaDB versions, collections in older ones
+            names = [
+                collection if isinstance(collection, str) else collection.name
+                for collection in get_client(path).list_collections()
+            ]
+            _collection_names[key] = names
+        return list(names)
+
+
+def invalidate(path: Optional[str] = None, name: Optional[str] = None):
+    """Forget cached handles and listings, of one collection, one directory or everything.
+    Needed when another process creates or deletes collections in the same directory."""
+    with _lock:
+        if path is None and name is None:
+            _collections.clear()
+            _collection_names.clear()
+            return
+        key = _path_key(path)
+        for collection_key in [k for k in _collections if k[0] == key and (name is None or k[1] == name)]:
+            del _collections[collection_key]
+        _collection_names.pop(key, None)
@@ -0,0 +1,134 @@
+import os
+import hashlib
+import sqlite3
+import time
+import unicodedata
+from typing import List, Optional, Sequence
+import numpy as np
+import sqlite_store
+
+LOOKUP_BATCH_SIZE = 500  # hashes per SELECT, below SQLite's bound parameter limit
+LAST_USED_RESOLUTION = 600  # seconds, a hit only rewrites last_used when it is older than this
+
+
+def normalize_text(text: str) -> str:
+    """Texts differing only in Unicode form or whitespace share one cache entry"""
+    return unicodedata.normalize('NFC', ' '.join(text.split()))
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache in SQLite, keyed by (model name, SHA-256 of the normalized text).
+    Vectors are stored as float32 blobs. When the stored vectors exceed ``max_bytes`` the least
+    recently used entries are evicted, so the same slide text is embedded once for every user,
+    collection and re-upload. The total size of the vectors is kept in the cache_meta table,
+    so writes do not have to sum the whole table.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.path = path or os.getenv('EMBEDDING_CACHE_PATH', './embedding_cache.sqlite')
+        self.max_bytes = max_bytes or int(os.getenv('EMBEDDING_CACHE_MAX_MB', '512')) * 1024 * 1024
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with sqlite_store.connect(self.path) as cache:
+            # WAL lets lookups run while another thread or process writes
+            cache.execute("PRAGMA journal_mode=WAL")
+            cache.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, text_hash)
+                ) WITHOUT ROWID
+            """)
+            cache.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            cache.execute("CREATE TABLE IF NOT EXISTS cache_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            # Caches created before the size was tracked are summed once
+            cache.execute("""
+                INSERT OR IGNORE INTO cache_meta (key, value)
+                SELECT 'total_bytes', COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings
+            """)
+
+    def get_many(self, model_name: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Return the cached vector of every text, None for texts that are not cached"""
+        hashes = [text_hash(text) for text in texts]
+        found, stale = {}, []
+        now = time.time()
+        with sqlite_store.connect(self.path) as cache:
+            for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+                batch = list(set(hashes[start:start + LOOKUP_BATCH_SIZE]))
+                rows = cache.execute(
+                    f"SELECT text_hash, vector, last_used FROM embeddings "
+                    f"WHERE model = ? AND text_hash IN ({', '.join('?' * len(batch))})",
+                    [model_name] + batch
+                ).fetchall()
+                for found_hash, vector, last_used in rows:
+                    found[found_hash] = vector
+                    if now - last_used > LAST_USED_RESOLUTION:
+                        stale.append(found_hash)
+            # Recency only needs to be approximate for LRU eviction, so hot entries are not
+            # rewritten on every lookup and most lookups stay read-only
+            if stale:
+                cache.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model_name, stale_hash) for stale_hash in stale]
+                )
+        return [
+            np.frombuffer(found[hash_], dtype=np.float32).tolist() if hash_ in found else None
+            for hash_ in hashes
+        ]
+
+    def put_many(self, model_name: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        now = time.time()
+        rows = [
+            (model_name, text_hash(text), np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with sqlite_store.connect(self.path) as cache:
+            added_bytes = 0
+            for row in rows:
+                # A vector only depends on the model and the text, an entry stored meanwhile is kept as is
+                inserted = cache.execute(
+                    "INSERT OR IGNORE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                    row
+                ).rowcount
+                added_bytes += len(row[2]) if inserted else 0
+            if added_bytes:
+                cache.execute("UPDATE cache_meta SET value = value + ? WHERE key = 'total_bytes'", (added_bytes,))
+            self._evict(cache)
+
+    def _evict(self, cache: sqlite3.Connection):
+        """Drop least recently used vectors until the cache is back to 90% of max_bytes"""
+        total_bytes = cache.execute("SELECT value FROM cache_meta WHERE key = 'total_bytes'").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+
+        target = total_bytes - int(self.max_bytes * 0.9)
+        freed, evicted = 0, []
+        cursor = cache.execute("SELECT model, text_hash, LENGTH(vector) FROM embeddings ORDER BY last_used")
+        for model, hash_, size in cursor:
+            if freed >= target:
+                break
+            evicted.append((model, hash_))
+            freed += size
+        cursor.close()
+        cache.executemany("DELETE FROM embeddings WHERE model = ? AND text_hash = ?", evicted)
+        cache.execute("UPDATE cache_meta SET value = value - ? WHERE key = 'total_bytes'", (freed,))
+
+
+_cache: Optional[EmbeddingCache] = None
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Process-wide cache, None when disabled with EMBEDDING_CACHE_MAX_MB=0"""
+    global _cache
+    if _cache is None and int(os.getenv('EMBEDDING_CACHE_MAX_MB', '512')) > 0:
+        _cache = EmbeddingCache()
+    return _cache
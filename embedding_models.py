@@ -0,0 +1,171 @@
+import atexit
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from embedding_cache import get_embedding_cache
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+try:
+    import psutil
+except ImportError:
+    psutil = None
+    import resource
+
+
+def _rss_mb() -> float:
+    """Resident memory of the process in MB, the peak RSS when psutil is not installed"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class EmbeddingModelRegistry:
+    """
+    Process-wide registry of sentence-transformers models.
+    Each model is loaded once, on first use, and shared by every retriever, collection manager
+    and token splitter of the process. Loading is thread-safe: concurrent callers of a model
+    that is being loaded wait for that load instead of starting their own.
+    """
+
+    def __init__(self):
+        self._models: Dict[str, 'SentenceTransformer'] = {}
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.load_stats: Dict[str, Dict[str, float]] = {}
+        # model name -> (number of workers, multi-process pool)
+        self._pools: Dict[str, tuple] = {}
+        atexit.register(self.stop_pools)
+
+    def get(self, model_name: str) -> 'SentenceTransformer':
+        model = self._models.get(model_name)
+        if model is not None:
+            return model
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(model_name, threading.Lock())
+        with load_lock:
+            if model_name not in self._models:
+                self._models[model_name] = self._load(model_name)
+        return self._models[model_name]
+
+    def _load(self, model_name: str) -> 'SentenceTransformer':
+        # Imported on the first load, importing the registry then does not import torch
+        from sentence_transformers import SentenceTransformer
+
+        rss_before = _rss_mb()
+        started = time.perf_counter()
+        model = SentenceTransformer(model_name)
+        load_seconds = time.perf_counter() - started
+        rss_delta = _rss_mb() - rss_before
+
+        self.load_stats[model_name] = {'load_seconds': load_seconds, 'rss_delta_mb': rss_delta}
+        print(f"Loaded embedding model {model_name} in {load_seconds:.1f}s (+{rss_delta:.0f} MB RSS)")
+        return model
+
+    def loaded_models(self) -> Dict[str, Dict[str, float]]:
+        """Load time and memory of every model loaded so far"""
+        return dict(self.load_stats)
+
+    def get_pool(self, model_name: str, workers: int):
+        """Return a pool of ``workers`` CPU processes encoding with the model, started once and reused"""
+        model = self.get(model_name)
+        with self._lock:
+            pool_workers, pool = self._pools.get(model_name, (0, None))
+            if pool is None or pool_workers != workers:
+                if pool is not None:
+                    model.stop_multi_process_pool(pool)
+                pool = model.start_multi_process_pool(target_devices=['cpu'] * workers)
+                self._pools[model_name] = (workers, pool)
+            return pool
+
+    def stop_pools(self):
+        with self._lock:
+            if not self._pools:
+                return
+            # A pool was started from a loaded model, so this does not import sentence_transformers anew
+            from sentence_transformers import SentenceTransformer
+            for _, pool in self._pools.values():
+                SentenceTransformer.stop_multi_process_pool(pool)
+            self._pools.clear()
+
+
+registry = EmbeddingModelRegistry()
+
+
+def get_embedding_model(model_name: str) -> 'SentenceTransformer':
+    return registry.get(model_name)
+
+
+def _embedding_settings(batch_size: Optional[int] = None, workers: Optional[int] = None):
+    batch_size = batch_size or int(os.getenv('EMBEDDING_BATCH_SIZE', '64'))
+    workers = int(os.getenv('EMBEDDING_WORKERS', '0')) if workers is None else workers
+    return batch_size, workers
+
+
+def ingest_batch_size() -> int:
+    """Number of chunks to hand to embed_texts at once so every embedding worker gets several batches"""
+    batch_size, workers = _embedding_settings()
+    return batch_size * max(workers, 1) * 4
+
+
+def cached_embeddings(model_name: str, texts: Sequence[str], encode) -> List[List[float]]:
+    """Return the embeddings of texts from the persistent cache, calling ``encode`` only with the
+    texts that are not cached yet"""
+    texts = list(texts)
+    cache = get_embedding_cache()
+    if cache is None or not texts:
+        return encode(texts) if texts else []
+
+    embeddings = cache.get_many(model_name, texts)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        vectors = encode(missing_texts)
+        cache.put_many(model_name, missing_texts, vectors)
+        for i, vector in zip(missing, vectors):
+            embeddings[i] = vector
+    return embeddings
+
+
+def embed_texts(model_name: str, texts: Sequence[str], batch_size: Optional[int] = None,
+                workers: Optional[int] = None) -> List[List[float]]:
+    """Embed texts for ingestion, ``batch_size`` texts per forward pass (EMBEDDING_BATCH_SIZE).
+    With ``workers`` > 1 (EMBEDDING_WORKERS) the batches are spread across a pool of CPU processes,
+    which is only worth it when there are enough texts to keep every worker busy.
+    Texts embedded before are served from the persistent embedding cache."""
+    batch_size, workers = _embedding_settings(batch_size, workers)
+    return cached_embeddings(model_name, texts, lambda missing: _encode(model_name, missing, batch_size, workers))
+
+
+def _encode(model_name: str, texts: List[str], batch_size: int, workers: int) -> List[List[float]]:
+    if workers > 1 and len(texts) > batch_size:
+        pool = registry.get_pool(model_name, workers)
+        embeddings = registry.get(model_name).encode_multi_process(texts, pool, batch_size=batch_size)
+    else:
+        embeddings = registry.get(model_name).encode(texts, batch_size=batch_size, convert_to_numpy=True)
+    return embeddings.tolist()
+
+
+class SharedEmbeddingFunction(EmbeddingFunction):
+    """ChromaDB embedding function backed by the shared registry model.
+    Creating one is free, the model is only loaded when the first texts are embedded."""
+
+    def __init__(self, model_name: str, normalize_embeddings: bool = False, model_registry: Optional[EmbeddingModelRegistry] = None):
+        self.model_name = model_name
+        self.normalize_embeddings = normalize_embeddings
+        self.model_registry = model_registry or registry
+
+    def __call__(self, input: Documents) -> Embeddings:
+        if self.normalize_embeddings:
+            # Cached vectors are not normalized, normalized ones are not cached
+            return self._encode(list(input))
+        return cached_embeddings(self.model_name, input, self._encode)
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        model = self.model_registry.get(self.model_name)
+        return model.encode(
+            texts, convert_to_numpy=True, normalize_embeddings=self.normalize_embeddings
+        ).tolist()
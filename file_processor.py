@@ -1,58 +1,75 @@
 import os
-from typing import List, BinaryIO
-import pythoncom
-from win32com import client
+from typing import Iterator, List, BinaryIO, Optional, Tuple
+import numpy as np
+try:
+    # Office automation is only available on Windows, native text extraction works everywhere
+    import pythoncom
+    from win32com import client
+except ImportError:
+    pythoncom = client = None
 import tempfile
+from contextlib import contextmanager
 import fitz  # PyMuPDF
 from pdf2image import convert_from_path
 from docx import Document
 from pptx import Presentation
 from io import BytesIO
-import requests
+from file_store import FileStore, url_extension
 
 class FileProcessor:
-    def __init__(self):
+    def __init__(self, file_store: Optional[FileStore] = None):
         self.supported_extensions = ['.txt', '.pdf', '.docx', '.pptx']
+        self.file_store = file_store or FileStore()
         
-    def convert_to_pdf(self, file_url: str) -> BytesIO:
-        """Convert various file formats to PDF"""
-        response = requests.get(file_url)
-        file_content = BytesIO(response.content)
-        file_extension = os.path.splitext(file_url)[1].lower()
+    @contextmanager
+    def convert_to_pdf(self, file_url: str, timemodified: Optional[int] = None,
+                       filesize: Optional[int] = None) -> Iterator[BinaryIO]:
+        """Convert various file formats to PDF, use as ``with processor.convert_to_pdf(url) as pdf:``.
+        Pass the Moodle timemodified/filesize of the file to reuse a stored copy instead of downloading it."""
+        file_path = self.file_store.fetch(file_url, timemodified, filesize)
+        with self.convert_file_to_pdf(file_path, url_extension(file_url)) as pdf_file:
+            yield pdf_file
+
+    @contextmanager
+    def convert_file_to_pdf(self, file_path: str, file_extension: Optional[str] = None) -> Iterator[BinaryIO]:
+        """Convert a local file to PDF. A PDF is opened instead of being read into memory,
+        the file is closed when the with block exits."""
+        file_extension = file_extension or os.path.splitext(file_path)[1].lower()
         
         if file_extension == '.pdf':
-            return file_content
+            pdf_file = open(file_path, 'rb')
         elif file_extension == '.txt':
-            return self._convert_txt_to_pdf(file_content)
+            pdf_file = self._convert_txt_to_pdf(file_path)
         elif file_extension == '.docx':
-            return self._convert_docx_to_pdf(file_content)
+            pdf_file = self._convert_docx_to_pdf(file_path)
         elif file_extension == '.pptx':
-            return self._convert_pptx_to_pdf(file_content)
+            pdf_file = self._convert_pptx_to_pdf(file_path)
         else:
             raise ValueError(f"Unsupported file format: {file_extension}")
+        with pdf_file:
+            yield pdf_file
 
-    def _convert_txt_to_pdf(self, file_content: BytesIO) -> BytesIO:
+    def _convert_txt_to_pdf(self, file_path: str) -> BytesIO:
         doc = fitz.open()
-        text = file_content.read().decode('utf-8')
+        with open(file_path, 'rb') as txt_file:
+            text = txt_file.read().decode('utf-8')
         page = doc.new_page()
         page.insert_text((50, 50), text)
         pdf_bytes = BytesIO(doc.tobytes())
         doc.close()
         return pdf_bytes
 
-    def _convert_docx_to_pdf(self, file_content: BytesIO) -> BytesIO:
-        # Save temporary DOCX file
-        with tempfile.NamedTemporaryFile(suffix='.docx', delete=False) as tmp_docx:
-            tmp_docx.write(file_content.getvalue())
-            tmp_docx_path = tmp_docx.name
+    def _convert_docx_to_pdf(self, file_path: str) -> BytesIO:
+        # Office needs an absolute path, the PDF is written to a temporary directory
+        tmp_dir = tempfile.mkdtemp()
+        pdf_path = os.path.join(tmp_dir, 'converted.pdf')
 
         # Initialize COM objects
         pythoncom.CoInitialize()
         word = client.Dispatch('Word.Application')
-        doc = word.Documents.Open(tmp_docx_path)
+        doc = word.Documents.Open(os.path.abspath(file_path))
         
         # Save as PDF
-        pdf_path = tmp_docx_path.replace('.docx', '.pdf')
         doc.SaveAs(pdf_path, FileFormat=17)  # 17 represents PDF format
         
         # Clean up
@@ -64,24 +81,22 @@ class FileProcessor:
             pdf_content = BytesIO(pdf_file.read())
         
         # Remove temporary files
-        os.unlink(tmp_docx_path)
         os.unlink(pdf_path)
+        os.rmdir(tmp_dir)
         
         return pdf_content
 
-    def _convert_pptx_to_pdf(self, file_content: BytesIO) -> BytesIO:
-        # Save temporary PPTX file
-        with tempfile.NamedTemporaryFile(suffix='.pptx', delete=False) as tmp_pptx:
-            tmp_pptx.write(file_content.getvalue())
-            tmp_pptx_path = tmp_pptx.name
+    def _convert_pptx_to_pdf(self, file_path: str) -> BytesIO:
+        # Office needs an absolute path, the PDF is written to a temporary directory
+        tmp_dir = tempfile.mkdtemp()
+        pdf_path = os.path.join(tmp_dir, 'converted.pdf')
 
         # Initialize COM objects
         pythoncom.CoInitialize()
         powerpoint = client.Dispatch('Powerpoint.Application')
-        presentation = powerpoint.Presentations.Open(tmp_pptx_path)
+        presentation = powerpoint.Presentations.Open(os.path.abspath(file_path))
         
         # Save as PDF
-        pdf_path = tmp_pptx_path.replace('.pptx', '.pdf')
         presentation.SaveAs(pdf_path, 32)  # 32 represents PDF format
         
         # Clean up
@@ -93,39 +108,62 @@ class FileProcessor:
             pdf_content = BytesIO(pdf_file.read())
         
         # Remove temporary files
-        os.unlink(tmp_pptx_path)
         os.unlink(pdf_path)
+        os.rmdir(tmp_dir)
         
         return pdf_content
 
-def chunk_text(text: str, chunk_size: int = 1500, overlap: int = 100) -> List[str]:
-    """Split text into chunks with specified size and overlap"""
-    words = text.split()
-    chunks = []
+# Whitespace lookup table by code point, as str.split() sees it. No whitespace is above U+3000,
+# the extra last entry stands for every higher code point.
+_WHITESPACE = np.array([chr(code).isspace() for code in range(0x3002)])
+_WHITESPACE[-1] = False
+
+
+def iter_chunk_spans(text: str, chunk_size: int = 1500, overlap: int = 100) -> Iterator[Tuple[str, int, int]]:
+    """Lazily split text into chunks of ``chunk_size`` words overlapping by ``overlap`` words,
+    ending a chunk early at the last period of the overlap region.
+    Yields (chunk, start, end) where text[start:end] is the span of the chunk in the original text.
+    Word offsets are computed once with NumPy and the period of each overlap region is found
+    with a single search of the original text instead of re-joining the region."""
+    if overlap >= chunk_size:
+        raise ValueError(f"overlap ({overlap}) must be smaller than chunk_size ({chunk_size})")
+
+    # Character offsets of every word, computed in bulk from a whitespace mask of the text;
+    # surrogatepass keeps lone surrogates left by PDF extraction as one code each
+    codes = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    in_word = ~_WHITESPACE[np.minimum(codes, len(_WHITESPACE) - 1)]
+    word_starts = np.flatnonzero(in_word & ~np.concatenate(([False], in_word[:-1])))
+    word_ends = np.flatnonzero(in_word & ~np.concatenate((in_word[1:], [False]))) + 1
+    word_count = len(word_starts)
+    # joined_offsets[i]: offset of word i in ' '.join(words)
+    joined_offsets = np.concatenate(([0], np.cumsum(word_ends - word_starts + 1)))
+
     start = 0
-    
-    while start < len(words):
+    while start < word_count:
         # Calculate end position for current chunk
         end = start + chunk_size
-        
+
         # If this is not the last chunk, adjust end to include overlap
-        if end < len(words):
-            # Find the last period in the overlap region
+        if end < word_count:
             overlap_start = end - overlap
-            overlap_text = ' '.join(words[overlap_start:end])
-            last_period = overlap_text.rfind('.')
-            
-            if last_period != -1:
+            # Find the last period of the overlap region in the original text, no join needed
+            position = text.rfind('.', word_starts[overlap_start], word_ends[end - 1]) if overlap_start < end else -1
+            if position != -1:
+                dot_index = int(np.searchsorted(word_starts, position, side='right')) - 1
+                last_period = int(joined_offsets[dot_index] - joined_offsets[overlap_start] + position - word_starts[dot_index])
                 # Adjust end to the last sentence boundary in overlap
                 end = overlap_start + last_period + 1
         else:
-            end = len(words)
-        
-        # Create chunk
-        chunk = ' '.join(words[start:end])
-        chunks.append(chunk)
-        
+            end = word_count
+
+        stop = min(end, word_count)
+        chunk_start, chunk_end = int(word_starts[start]), int(word_ends[stop - 1])
+        yield ' '.join(text[chunk_start:chunk_end].split()), chunk_start, chunk_end
+
         # Move start position for next chunk
-        start = end - overlap if end < len(words) else end
-    
-    return chunks
\ No newline at end of file
+        start = end - overlap if end < word_count else end
+
+
+def chunk_text(text: str, chunk_size: int = 1500, overlap: int = 100) -> List[str]:
+    """Split text into chunks with specified size and overlap"""
+    return [chunk for chunk, _, _ in iter_chunk_spans(text, chunk_size, overlap)]
@@ -0,0 +1,153 @@
+import os
+import hashlib
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, Iterable, Iterator, Tuple, Union
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+import requests
+import sqlite_store
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # bytes held in memory per download
+
+
+def url_extension(url: str) -> str:
+    """Return the lower-cased file extension of a URL's path, ignoring its query string"""
+    return os.path.splitext(urlparse(url).path)[1].lower()
+
+
+def normalize_url(url: str) -> str:
+    """Drop the per-user token from a Moodle file URL so every user maps to the same entry"""
+    parts = urlparse(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key != 'token']
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+
+class FileStore:
+    """
+    Content-addressed local store for downloaded course files.
+    Files are stored once under their SHA-256 and indexed by Moodle file URL together with the
+    timemodified/filesize the URL had when it was downloaded, so an unchanged file is never
+    downloaded again and identical bytes shared by several courses or users are stored once.
+    """
+
+    def __init__(self, root: Optional[str] = None, max_downloads: Optional[int] = None,
+                 timeout: Optional[Tuple[float, float]] = None):
+        self.root = root or os.getenv('FILE_STORE_PATH', './file_store')
+        # Upper bound on files downloaded in parallel by fetch_many
+        self.max_downloads = max_downloads or int(os.getenv('FILE_DOWNLOAD_CONCURRENCY', '4'))
+        # (connect, read) seconds, the read timeout bounds the wait for each chunk rather than the whole file
+        self.timeout = timeout or (float(os.getenv('FILE_DOWNLOAD_CONNECT_TIMEOUT', '5')),
+                                   float(os.getenv('FILE_DOWNLOAD_READ_TIMEOUT', '60')))
+        # requests.Session is not documented as thread-safe, every fetch_many thread gets its own
+        self._local = threading.local()
+        self.objects_dir = os.path.join(self.root, 'objects')
+        self.index_path = os.path.join(self.root, 'index.sqlite')
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        with sqlite_store.connect(self.index_path) as index:
+            index.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    url TEXT PRIMARY KEY,
+                    timemodified INTEGER,
+                    filesize INTEGER,
+                    sha256 TEXT NOT NULL,
+                    extension TEXT NOT NULL,
+                    fetched_at REAL NOT NULL
+                )
+            """)
+
+    @property
+    def session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def object_path(self, sha256: str, extension: str = '') -> str:
+        return os.path.join(self.objects_dir, sha256[:2], f"{sha256}{extension}")
+
+    def lookup(self, file_url: str, timemodified: Optional[int] = None,
+               filesize: Optional[int] = None) -> Optional[str]:
+        """Return the stored path of a file if this version of the URL was downloaded before.
+        Without a timemodified or filesize the version is unknown and nothing matches."""
+        if timemodified is None and filesize is None:
+            return None
+
+        with sqlite_store.connect(self.index_path) as index:
+            row = index.execute(
+                "SELECT timemodified, filesize, sha256, extension FROM files WHERE url = ?",
+                (normalize_url(file_url),)
+            ).fetchone()
+        if row is None or (row[0], row[1]) != (timemodified, filesize):
+            return None
+
+        path = self.object_path(row[2], row[3])
+        return path if os.path.exists(path) else None
+
+    def fetch(self, file_url: str, timemodified: Optional[int] = None, filesize: Optional[int] = None) -> str:
+        """Return a local path with the file's content, downloading it only if this version is not stored"""
+        path = self.lookup(file_url, timemodified, filesize)
+        if path is not None:
+            return path
+
+        sha256 = self._download(file_url)
+        extension = url_extension(file_url)
+        self._index(file_url, timemodified, filesize, sha256, extension)
+        return self.object_path(sha256, extension)
+
+    def fetch_many(self, files: Iterable[Tuple[str, Optional[int], Optional[int]]],
+                   max_downloads: Optional[int] = None) -> Iterator[Tuple[str, Union[str, Exception]]]:
+        """Fetch (file_url, timemodified, filesize) entries concurrently, at most ``max_downloads``
+        at a time (FILE_DOWNLOAD_CONCURRENCY).
+        Yields (file_url, path) as downloads complete, or (file_url, exception) for failed ones."""
+        with ThreadPoolExecutor(max_workers=max_downloads or self.max_downloads) as executor:
+            futures = {
+                executor.submit(self.fetch, file_url, timemodified, filesize): file_url
+                for file_url, timemodified, filesize in files
+            }
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as e:
+                    yield futures[future], e
+
+    def _download(self, file_url: str) -> str:
+        """Stream a file into the store and return its SHA-256.
+        Only DOWNLOAD_CHUNK_SIZE bytes are held in memory whatever the size of the file."""
+        extension = url_extension(file_url)
+        digest = hashlib.sha256()
+        # Spool into the objects directory, so the final rename stays on the same filesystem
+        tmp_file = tempfile.NamedTemporaryFile(dir=self.objects_dir, suffix='.part', delete=False)
+        try:
+            with tmp_file, self.session.get(file_url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+
+            sha256 = digest.hexdigest()
+            path = self.object_path(sha256, extension)
+            if os.path.exists(path):
+                os.unlink(tmp_file.name)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Readers never see a partial object, the rename is atomic
+                os.replace(tmp_file.name, path)
+            return sha256
+        except BaseException:
+            if os.path.exists(tmp_file.name):
+                os.unlink(tmp_file.name)
+            raise
+
+    def _index(self, file_url: str, timemodified: Optional[int], filesize: Optional[int],
+               sha256: str, extension: str):
+        with sqlite_store.connect(self.index_path) as index:
+            index.execute("""
+                INSERT INTO files (url, timemodified, filesize, sha256, extension, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET
+                    timemodified = excluded.timemodified, filesize = excluded.filesize,
+                    sha256 = excluded.sha256, extension = excluded.extension, fetched_at = excluded.fetched_at
+            """, (normalize_url(file_url), timemodified, filesize, sha256, extension, time.time()))
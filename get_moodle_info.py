@@ -1,4 +1,5 @@
 import requests
+from moodle_client import DEFAULT_TIMEOUT
 import json
 from getpass import getpass
 
@@ -22,7 +23,7 @@ def get_moodle_info():
         
         # Login sayfasını al
         login_url = f"{moodle_url}login/index.php"
-        response = session.get(login_url)
+        response = session.get(login_url, timeout=DEFAULT_TIMEOUT)
         
         if response.status_code != 200:
             print("❌ Moodle sitesine erişilemiyor!")
@@ -30,7 +31,7 @@ def get_moodle_info():
         
         # 2. User ID'yi bulmak için profil sayfasına git
         profile_url = f"{moodle_url}user/profile.php"
-        profile_response = session.get(profile_url)
+        profile_response = session.get(profile_url, timeout=DEFAULT_TIMEOUT)
         
         if profile_response.status_code == 200:
             # URL'den user ID'yi çıkar
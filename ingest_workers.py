@@ -0,0 +1,303 @@
+import os
+import time
+import atexit
+import threading
+import multiprocessing
+from bisect import bisect_right
+from multiprocessing.connection import wait
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from text_extractors import load_pages, ocr_time_budget
+
+
+class WorkerCrashedError(RuntimeError):
+    """Raised in place of a result when a worker process died without returning one"""
+
+
+def _worker_loop(connection, max_tasks: int):
+    """Run the tasks sent over ``connection`` until None is sent or ``max_tasks`` are done"""
+    done = 0
+    while not max_tasks or done < max_tasks:
+        try:
+            task = connection.recv()
+        except (EOFError, OSError):
+            break
+        if task is None:
+            break
+        fn, args = task
+        # The task's deadline runs from here, so starting a new worker does not count against it
+        connection.send(('started', None))
+        try:
+            result = ('ok', fn(*args))
+        except BaseException as e:
+            result = ('error', e)
+        try:
+            connection.send(result)
+        except Exception as e:
+            # The result or the exception could not be pickled
+            connection.send(('error', RuntimeError(f"Unable to return worker result: {e!r}")))
+        done += 1
+    connection.close()
+
+
+class _Worker:
+    def __init__(self, context, max_tasks: int):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_worker_loop, args=(child_connection, max_tasks), daemon=True)
+        self.process.start()
+        # Only the child holds its end now, so its death shows up as EOF
+        child_connection.close()
+        self.tasks_left = max_tasks or None
+
+    def stop(self, kill: bool = False):
+        if kill:
+            self.process.kill()
+        else:
+            # Closing this end is not enough when another process holds a copy of it
+            try:
+                self.connection.send(None)
+            except OSError:
+                pass
+        self.connection.close()
+        self.process.join()
+
+
+class WorkerPool:
+    """
+    Runs CPU-heavy ingestion tasks in parallel worker processes, at most ``max_workers`` at a time.
+    Workers are started on demand and reused for the next tasks, so the interpreter start and module
+    imports are paid once per worker rather than once per file; a worker is replaced after
+    ``max_tasks_per_child`` tasks, so leaks in the parsers do not accumulate. A malformed file that
+    crashes the parser or hangs past ``task_timeout`` seconds only fails its own task, and a hung
+    worker is killed and replaced. The timeout counts from when a worker picks the task up, a new
+    worker gets ``start_timeout`` seconds to start and import its modules before that.
+    Use the pool as a context manager, or call close(), to stop the workers.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, task_timeout: Optional[float] = None,
+                 max_tasks_per_child: Optional[int] = None, start_timeout: Optional[float] = None):
+        self.max_workers = max_workers or int(os.getenv('INGEST_WORKERS', '0')) or os.cpu_count() or 1
+        # Workers OCR the scanned pages of a file one after the other, so that time is allowed on top
+        self.task_timeout = task_timeout or float(os.getenv('INGEST_TASK_TIMEOUT', '300')) + ocr_time_budget()
+        self.max_tasks_per_child = (int(os.getenv('INGEST_MAX_TASKS_PER_CHILD', '50'))
+                                    if max_tasks_per_child is None else max_tasks_per_child)
+        self.start_timeout = start_timeout or float(os.getenv('INGEST_WORKER_START_TIMEOUT', '120'))
+        # Spawned rather than forked, workers then do not inherit the parent's threads, locks and
+        # loaded models (fork is the default on Linux)
+        self.context = multiprocessing.get_context('spawn')
+        self.idle: List[_Worker] = []
+        # Idle workers are shared by every upload of the process, see get_shared_pool
+        self._lock = threading.Lock()
+
+    def imap_unordered(self, fn: Callable, tasks: Iterable[tuple]) -> Iterator[Tuple[tuple, object]]:
+        """Run ``fn(*args)`` for every args tuple and yield (args, result) as tasks complete.
+        A failed task yields the exception as its result: the one it raised, a TimeoutError,
+        or a WorkerCrashedError."""
+        tasks = iter(tasks)
+        running = {}  # worker connection -> (worker, args, deadline, started)
+        exhausted = False
+
+        try:
+            while True:
+                while not exhausted and len(running) < self.max_workers:
+                    args = next(tasks, None)
+                    if args is None:
+                        exhausted = True
+                        break
+                    try:
+                        worker = self._submit(fn, args)
+                    except OSError as e:
+                        # The new worker died before it could read its task
+                        yield args, WorkerCrashedError(f"Worker could not be sent {args!r}: {e!r}")
+                        continue
+                    running[worker.connection] = (worker, args, time.monotonic() + self.start_timeout, False)
+
+                if not running:
+                    return
+
+                timeout = max(0, min(deadline for _, _, deadline, _ in running.values()) - time.monotonic())
+                for connection in wait(list(running), timeout):
+                    worker, args, _, _ = running.pop(connection)
+                    try:
+                        status, value = connection.recv()
+                        if status == 'started':
+                            running[connection] = (worker, args, time.monotonic() + self.task_timeout, True)
+                            continue
+                    except (EOFError, OSError):
+                        # A worker that dies before reading its task resets the connection instead of closing it
+                        worker.stop(kill=True)
+                        value = WorkerCrashedError(
+                            f"Worker exited with code {worker.process.exitcode} while processing {args!r}"
+                        )
+                    else:
+                        self._release(worker)
+                    yield args, value
+
+                now = time.monotonic()
+                for connection, (worker, args, deadline, started) in list(running.items()):
+                    if now >= deadline:
+                        del running[connection]
+                        worker.stop(kill=True)
+                        if started:
+                            yield args, TimeoutError(f"Task exceeded {self.task_timeout}s: {args!r}")
+                        else:
+                            yield args, TimeoutError(f"Worker did not start within {self.start_timeout}s: {args!r}")
+        finally:
+            # Workers still busy when the caller stops iterating are killed, their results would
+            # otherwise be read as the results of the next tasks
+            for worker, _, _, _ in running.values():
+                worker.stop(kill=True)
+
+    def _submit(self, fn: Callable, args: tuple) -> _Worker:
+        """Send a task to an idle worker, starting a new one when none is left"""
+        while True:
+            with self._lock:
+                if not self.idle:
+                    break
+                worker = self.idle.pop()
+            try:
+                worker.connection.send((fn, args))
+                return worker
+            except OSError:
+                # The worker died while idle
+                worker.stop()
+        worker = _Worker(self.context, self.max_tasks_per_child)
+        try:
+            worker.connection.send((fn, args))
+        except OSError:
+            worker.stop(kill=True)
+            raise
+        return worker
+
+    def _release(self, worker: _Worker):
+        if worker.tasks_left is not None:
+            worker.tasks_left -= 1
+            if worker.tasks_left <= 0:
+                # The worker exits by itself after its last task
+                worker.stop()
+                return
+        with self._lock:
+            self.idle.append(worker)
+
+    def close(self):
+        with self._lock:
+            idle, self.idle = self.idle, []
+        for worker in idle:
+            worker.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_shared_pool: Optional[WorkerPool] = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_shared_pool() -> WorkerPool:
+    """Process-wide pool, its workers are reused by every upload and stopped when the process exits"""
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = WorkerPool()
+            atexit.register(_shared_pool.close)
+    return _shared_pool
+
+
+def _character_splitter(chunk_size: int, chunk_overlap: int) -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
+        separators=["\n\n", "\n", ". ", " ", ""],
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        add_start_index=True
+    )
+
+
+def _page_at(page_offsets: List[int], page_numbers: List[int], offset: int) -> int:
+    """Number of the page a text offset falls on, given where each page starts"""
+    return page_numbers[max(bisect_right(page_offsets, offset) - 1, 0)]
+
+
+def split_pages(pages: Iterable[Tuple[int, str]], chunk_size: int = 1500,
+                chunk_overlap: int = 0) -> List[Tuple[str, int]]:
+    """Split the text of all (page number, text) pairs, joined by blank lines, in one pass.
+    Returns (chunk, page number the chunk starts on) pairs."""
+    page_offsets, page_numbers, page_texts = [], [], []
+    offset = 0
+    for page_number, text in pages:
+        page_offsets.append(offset)
+        page_numbers.append(page_number)
+        page_texts.append(text)
+        offset += len(text) + 2
+
+    documents = _character_splitter(chunk_size, chunk_overlap).create_documents(['\n\n'.join(page_texts)])
+    return [
+        (document.page_content, _page_at(page_offsets, page_numbers, document.metadata['start_index']))
+        for document in documents
+    ]
+
+
+def iter_char_chunks(pages: Iterable[Tuple[int, str]], chunk_size: int = 1500, chunk_overlap: int = 0,
+                     window_chunks: int = 8) -> Iterator[Tuple[str, int]]:
+    """Split a stream of (page number, text) pairs into character chunks, for documents too large
+    to split in one pass with split_pages. Only about ``window_chunks * chunk_size`` characters are
+    held at a time whatever the size of the document. Yields (chunk, page number the chunk starts on)
+    pairs; chunk boundaries may differ from the ones of split_pages."""
+    character_splitter = _character_splitter(chunk_size, chunk_overlap)
+    buffer = ''
+    page_offsets, page_numbers = [], []  # where each page still in the buffer starts
+
+    def with_pages(documents):
+        for document in documents:
+            yield document.page_content, _page_at(page_offsets, page_numbers, document.metadata['start_index'])
+
+    for page_number, text in pages:
+        if buffer:
+            buffer += '\n\n'
+        page_offsets.append(len(buffer))
+        page_numbers.append(page_number)
+        buffer += text
+
+        if len(buffer) < window_chunks * chunk_size:
+            continue
+        documents = character_splitter.create_documents([buffer])
+        if len(documents) < 2:
+            continue
+        # The last chunk may continue on the next page, it is split again with what follows
+        yield from with_pages(documents[:-1])
+        cut = documents[-1].metadata['start_index']
+        first = max(bisect_right(page_offsets, cut) - 1, 0)
+        page_offsets = [0] + [offset - cut for offset in page_offsets[first + 1:]]
+        page_numbers = page_numbers[first:]
+        buffer = buffer[cut:]
+
+    if buffer:
+        yield from with_pages(character_splitter.create_documents([buffer]))
+
+
+def extract_and_chunk(file_path: str, chunk_size: int = 1500, chunk_overlap: int = 0,
+                      pdf_backend: Optional[str] = None) -> List[Tuple[str, int]]:
+    """Worker task: read a document and split it into (character chunk, page number) pairs.
+    Only the extraction and splitting modules are imported here, so workers do not load
+    ChromaDB or the embedding model."""
+    chunks = split_pages(load_pages(file_path, pdf_backend), chunk_size, chunk_overlap)
+
+    print(f"\nTotal number of chunks (document split by max char = {chunk_size}): {len(chunks)}")
+    return chunks
+
+
+def chunk_files(file_paths: Iterable[str], chunk_size: int = 1500, chunk_overlap: int = 0,
+                pool: Optional[WorkerPool] = None, pdf_backend: Optional[str] = None) -> Iterator[Tuple[str, object]]:
+    """Extract and chunk many files in parallel, yielding (file_path, (chunk, page number) pairs or exception)
+    as they complete"""
+    owns_pool = pool is None
+    pool = pool or WorkerPool()
+    tasks = ((file_path, chunk_size, chunk_overlap, pdf_backend) for file_path in file_paths)
+    try:
+        for args, result in pool.imap_unordered(extract_and_chunk, tasks):
+            yield args[0], result
+    finally:
+        if owns_pool:
+            pool.close()
@@ -0,0 +1,293 @@
+import os
+import re
+import json
+import math
+import shutil
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r'\w+')
+MAX_TERM_CHARS = 32  # longer tokens are truncated, terms are stored as fixed-width byte strings
+MERGE_FACTOR = 8  # segments of one size tier are merged into one when there are this many
+BM25_K1 = 1.5
+BM25_B = 0.75
+SEGMENT_ARRAYS = ('terms', 'term_offsets', 'postings_docs', 'postings_tf', 'doc_ids', 'doc_lengths')
+
+
+def tokenize(text: str) -> List[bytes]:
+    """Lower-cased word tokens, so course codes and 'HW3'-style tokens stay whole"""
+    return [token[:MAX_TERM_CHARS].encode('utf-8') for token in TOKEN_PATTERN.findall(text.lower())]
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[str]], k: int = 60) -> List[str]:
+    """Fuse several rankings of IDs, each ID scoring sum(1 / (k + rank)) over the rankings it appears in"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+def _write_segment(path: str, doc_ids: np.ndarray, doc_lengths: np.ndarray,
+                   posting_terms: np.ndarray, posting_docs: np.ndarray, posting_tfs: np.ndarray):
+    """Write a segment as one .npy file per array, posting lists sorted by term then document"""
+    order = np.lexsort((posting_docs, posting_terms))
+    sorted_terms = posting_terms[order]
+    terms, term_starts = np.unique(sorted_terms, return_index=True)
+    arrays = {
+        'terms': terms,
+        'term_offsets': np.append(term_starts, len(sorted_terms)).astype(np.int64),
+        'postings_docs': posting_docs[order].astype(np.int32),
+        'postings_tf': posting_tfs[order].astype(np.int32),
+        'doc_ids': doc_ids,
+        'doc_lengths': doc_lengths.astype(np.int32),
+    }
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+    os.replace(tmp_path, path)
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index of one collection's chunks, built incrementally at ingestion time.
+    Every write adds an immutable segment of NumPy arrays (sorted terms, posting list offsets,
+    posting documents and term frequencies) that is memory-mapped for search. Deleted chunks are
+    tombstoned in the manifest and dropped when segments are merged. Segments are merged by size
+    tier, so a chunk is rewritten about log(N) / log(MERGE_FACTOR) times however many batches the
+    collection is ingested in.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.manifest_path = os.path.join(path, 'manifest.json')
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r', encoding='utf-8') as manifest_file:
+                self.manifest = json.load(manifest_file)
+        else:
+            self.manifest = {'segments': [], 'next_segment': 0, 'tombstones': {}}
+
+        self.segments: Dict[int, Dict[str, np.ndarray]] = {}
+        self.live: Dict[int, np.ndarray] = {}
+        self.locations: Dict[str, Tuple[int, int]] = {}  # live chunk id -> (segment, position)
+        self.total_length = 0
+        for number in self.manifest['segments']:
+            self._load_segment(number)
+
+    def _load_segment(self, number: int):
+        segment_path = os.path.join(self.path, f"segment_{number}")
+        segment = {name: np.load(os.path.join(segment_path, f"{name}.npy"), mmap_mode='r') for name in SEGMENT_ARRAYS}
+        doc_ids = [doc_id.decode('utf-8') for doc_id in segment['doc_ids']]
+        # A chunk is dead in the segments that existed when it was deleted
+        tombstones = self.manifest['tombstones']
+        live = np.array([tombstones.get(doc_id, -1) < number for doc_id in doc_ids], dtype=bool)
+        self.segments[number] = segment
+        self.live[number] = live
+        for position in np.flatnonzero(live):
+            self.locations[doc_ids[position]] = (number, int(position))
+        self.total_length += int(segment['doc_lengths'][live].sum())
+
+    def _save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(self.manifest, manifest_file)
+        os.replace(tmp_path, self.manifest_path)
+
+    def __len__(self) -> int:
+        return len(self.locations)
+
+    def add(self, ids: Sequence[str], texts: Sequence[str]):
+        """Index chunks, chunks whose ID is already indexed are skipped"""
+        with self._lock:
+            doc_ids, doc_lengths, posting_terms, posting_docs, posting_tfs = [], [], [], [], []
+            added = set()
+            for chunk_id, text in zip(ids, texts):
+                if chunk_id in self.locations or chunk_id in added:
+                    continue
+                added.add(chunk_id)
+                tokens = tokenize(text)
+                for term, tf in Counter(tokens).items():
+                    posting_terms.append(term)
+                    posting_docs.append(len(doc_ids))
+                    posting_tfs.append(tf)
+                doc_ids.append(chunk_id.encode('utf-8'))
+                doc_lengths.append(len(tokens))
+            if not doc_ids:
+                return
+
+            number = self.manifest['next_segment']
+            _write_segment(
+                os.path.join(self.path, f"segment_{number}"),
+                np.array(doc_ids), np.array(doc_lengths),
+                np.array(posting_terms, dtype=bytes), np.array(posting_docs), np.array(posting_tfs)
+            )
+            self.manifest['segments'].append(number)
+            self.manifest['next_segment'] = number + 1
+            self._save_manifest()
+            self._load_segment(number)
+            self._merge_tiers()
+
+    def delete(self, ids: Iterable[str]):
+        with self._lock:
+            last_segment = self.manifest['next_segment'] - 1
+            for chunk_id in ids:
+                location = self.locations.pop(chunk_id, None)
+                if location is None:
+                    continue
+                number, position = location
+                self.live[number][position] = False
+                self.total_length -= int(self.segments[number]['doc_lengths'][position])
+                self.manifest['tombstones'][chunk_id] = last_segment
+            self._save_manifest()
+
+    def _segment_tier(self, number: int) -> int:
+        """Size tier of a segment, by number of live chunks: MERGE_FACTOR ** tier <= size < MERGE_FACTOR ** (tier + 1)"""
+        size, tier = int(self.live[number].sum()), 0
+        while size >= MERGE_FACTOR:
+            size //= MERGE_FACTOR
+            tier += 1
+        return tier
+
+    def _merge_tiers(self):
+        """Merge the segments of every size tier that holds MERGE_FACTOR of them, until none does"""
+        while True:
+            tiers: Dict[int, List[int]] = {}
+            for number in self.manifest['segments']:
+                tiers.setdefault(self._segment_tier(number), []).append(number)
+            full = [numbers for numbers in tiers.values() if len(numbers) >= MERGE_FACTOR]
+            if not full:
+                return
+            self._merge_segments(full[0])
+
+    def _merge_segments(self, numbers: List[int]):
+        """Rewrite the live postings of the given segments into a single segment"""
+        doc_ids, doc_lengths, posting_terms, posting_docs, posting_tfs = [], [], [], [], []
+        base = 0
+        for number in numbers:
+            segment, live = self.segments[number], self.live[number]
+            new_positions = np.cumsum(live) - 1 + base
+            terms = np.repeat(segment['terms'], np.diff(segment['term_offsets']))
+            keep = live[segment['postings_docs']]
+            posting_terms.append(terms[keep])
+            posting_docs.append(new_positions[segment['postings_docs'][keep]])
+            posting_tfs.append(np.asarray(segment['postings_tf'])[keep])
+            doc_ids.append(np.asarray(segment['doc_ids'])[live])
+            doc_lengths.append(np.asarray(segment['doc_lengths'])[live])
+            base += int(live.sum())
+        # Only copies are kept past this point, the loop variables still reference the memory maps
+        segment = live = keep = None
+
+        merged = self.manifest['next_segment']
+        _write_segment(
+            os.path.join(self.path, f"segment_{merged}"),
+            np.concatenate(doc_ids), np.concatenate(doc_lengths),
+            np.concatenate(posting_terms), np.concatenate(posting_docs), np.concatenate(posting_tfs)
+        )
+        segments = [number for number in self.manifest['segments'] if number not in numbers] + [merged]
+        # A tombstone only hides a chunk in segments numbered up to it, older ones are no longer needed
+        oldest = min(segments)
+        tombstones = {
+            chunk_id: last_segment for chunk_id, last_segment in self.manifest['tombstones'].items()
+            if last_segment >= oldest
+        }
+        self.manifest = {'segments': segments, 'next_segment': merged + 1, 'tombstones': tombstones}
+        self._save_manifest()
+
+        # Drop the memory maps of the merged segments before removing the files they map
+        for number in numbers:
+            self.total_length -= int(self.segments[number]['doc_lengths'][self.live[number]].sum())
+            del self.segments[number], self.live[number]
+        # Their live chunks are relocated to the merged segment
+        self._load_segment(merged)
+        # Segments a previous merge failed to remove are removed too
+        kept = {f"segment_{number}" for number in segments}
+        for name in os.listdir(self.path):
+            if name.startswith('segment_') and name not in kept:
+                try:
+                    shutil.rmtree(os.path.join(self.path, name))
+                except OSError as e:
+                    # Still mapped by a reader on Windows, it is retried at the next merge
+                    print(f"Unable to remove merged lexical index segment {name}: {str(e)}")
+
+    def search(self, query: str, n_results: int = 10) -> List[Tuple[str, float]]:
+        """Return up to n_results (chunk id, BM25 score) pairs, best first"""
+        with self._lock:
+            doc_count = len(self.locations)
+            terms = list(dict.fromkeys(tokenize(query)))
+            if doc_count == 0 or not terms:
+                return []
+            average_length = self.total_length / doc_count
+
+            # Live postings of every query term in every segment
+            postings = {number: [] for number in self.segments}
+            document_frequencies = {}
+            for term in terms:
+                document_frequencies[term] = 0
+                for number, segment in self.segments.items():
+                    index = int(np.searchsorted(segment['terms'], term))
+                    if index == len(segment['terms']) or segment['terms'][index] != term:
+                        continue
+                    start, stop = segment['term_offsets'][index], segment['term_offsets'][index + 1]
+                    docs = np.asarray(segment['postings_docs'][start:stop])
+                    tfs = np.asarray(segment['postings_tf'][start:stop])
+                    live = self.live[number][docs]
+                    postings[number].append((term, docs[live], tfs[live]))
+                    document_frequencies[term] += int(live.sum())
+
+            candidates_ids, candidates_scores = [], []
+            for number, term_postings in postings.items():
+                if not term_postings:
+                    continue
+                segment = self.segments[number]
+                scores = np.zeros(len(segment['doc_ids']))
+                for term, docs, tfs in term_postings:
+                    df = document_frequencies[term]
+                    idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+                    lengths = segment['doc_lengths'][docs]
+                    np.add.at(scores, docs, idf * tfs * (BM25_K1 + 1) / (
+                        tfs + BM25_K1 * (1 - BM25_B + BM25_B * lengths / average_length)
+                    ))
+                matched = np.flatnonzero(scores)
+                candidates_ids.extend(segment['doc_ids'][matched])
+                candidates_scores.extend(scores[matched])
+
+            order = np.argsort(candidates_scores)[::-1][:n_results]
+            return [(candidates_ids[i].decode('utf-8'), float(candidates_scores[i])) for i in order]
+
+
+_indexes: Dict[str, LexicalIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def index_path(chroma_path: str, collection_name: str) -> str:
+    root = os.getenv('LEXICAL_INDEX_PATH') or os.path.join(chroma_path, 'lexical')
+    return os.path.abspath(os.path.join(root, collection_name))
+
+
+def get_index(chroma_path: Optional[str], collection_name: str) -> Optional[LexicalIndex]:
+    """Shared lexical index of a collection, None for in-memory ChromaDB collections"""
+    if chroma_path is None:
+        return None
+    path = index_path(chroma_path, collection_name)
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = LexicalIndex(path)
+        return _indexes[path]
+
+
+def drop_index(chroma_path: Optional[str], collection_name: str):
+    if chroma_path is None:
+        return
+    path = index_path(chroma_path, collection_name)
+    with _indexes_lock:
+        _indexes.pop(path, None)
+        shutil.rmtree(path, ignore_errors=True)
@@ -3,17 +3,111 @@ from mysql.connector import Error
 import requests
 from dotenv import load_dotenv
 import os
-from typing import List, Dict, Tuple
+import json
+from typing import List, Dict, Tuple, Iterator, Optional
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+import threading
+from moodle_client import MoodleClient, MoodleError
 
 # Load environment variables
 load_dotenv()
 
-class ContentProcessor:
+SUPPORTED_EXTENSIONS = ('.pdf', '.docx', '.pptx', '.txt')
+
+# SQL expression for a user's visible sync generation, takes the user_id as parameter
+ACTIVE_GENERATION_SQL = "COALESCE((SELECT s.active_generation FROM content_sync_state s WHERE s.user_id = %s), 0)"
+
+# Moodle error codes that mean the user may not see a course or activity, these fail the same way every time
+PERMANENT_MOODLE_ERRORS = frozenset([
+    'nopermissions', 'requireloginerror', 'accessexception', 'invalidrecord', 'invalidcourseid',
+    'coursehidden', 'errorcoursecontextnotvalid'
+])
+
+def is_transient_error(error: Exception) -> bool:
+    """Whether a failed Moodle call may succeed later: network errors, 429 and 5xx responses, and
+    Moodle exceptions other than PERMANENT_MOODLE_ERRORS. Moodle reports its own failures
+    (dml_read_exception...) as exception payloads too, so unknown error codes are retried.
+    Other 4xx answers fail the same way every time."""
+    if isinstance(error, MoodleError):
+        return error.errorcode not in PERMANENT_MOODLE_ERRORS
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return True
+
+class SyncIncompleteError(Exception):
+    """Raised after a sync in which some courses or forums could not be fetched"""
+
+    def __init__(self, failures: List[Tuple[str, int, int]]):
+        self.failures = failures
+        super().__init__(f"{len(failures)} course or forum fetches failed: " + ', '.join(
+            f"{kind} {unit_id} of course {course_id}" for kind, course_id, unit_id in failures
+        ))
+
+class SyncInProgressError(Exception):
+    """Raised when another sync of the same user is still running"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        super().__init__(f"A sync of user {user_id} is already in progress")
+
+class FetchCache:
+    """
+    Memoizes Moodle responses across the users synced in one scheduler cycle,
+    so each course's contents are fetched once however many users are enrolled.
+    Concurrent lookups of the same key wait for the first fetch instead of repeating it.
+    Failed fetches are not memoized, the next lookup of the key fetches again.
+    """
+
     def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple, Future] = {}
+
+    def get(self, key: Tuple, fetch):
+        with self._lock:
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = self._entries[key] = Future()
+
+        if owner:
+            try:
+                entry.set_result(fetch())
+            except Exception as e:
+                with self._lock:
+                    self._entries.pop(key, None)
+                entry.set_exception(e)
+        return entry.result()
+
+    def peek(self, key: Tuple, default=None):
+        """Return the memoized result of a key without fetching it, ``default`` while it is not known"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or not entry.done() or entry.exception() is not None:
+            return default
+        return entry.result()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+class ContentProcessor:
+    def __init__(self, max_concurrency: Optional[int] = None, client: Optional[MoodleClient] = None,
+                 batch_size: Optional[int] = None, fetch_cache: Optional[FetchCache] = None):
         self.token = None
         self.user_id = None
         self.moodle_user_id = None
         self.base_url = os.getenv('MOODLE_BASE_URL')
+        # Upper bound on concurrent Moodle requests during a crawl
+        self.max_concurrency = max_concurrency or int(os.getenv('MOODLE_MAX_CONCURRENCY', '8'))
+        # Shared keep-alive session, created lazily because base_url may be set after construction
+        self.client = client
+        self._owns_client = False
+        # Maximum number of rows sent in one multi-row statement
+        self.batch_size = batch_size or int(os.getenv('MYSQL_BATCH_SIZE', '500'))
+        # Responses shared with other users' syncs, set by the background scheduler
+        self.fetch_cache = fetch_cache
+        # Forum discussions are fetched and written page by page
+        self.forum_page_size = int(os.getenv('MOODLE_FORUM_PAGE_SIZE', '100'))
 
     def get_mysql_connection(self) -> mysql.connector.connection.MySQLConnection:
         """Establish MySQL connection"""
@@ -25,98 +119,346 @@ class ContentProcessor:
         }
         return mysql.connector.connect(**config)
 
-    def populate_database(self):
-        """Populate database with course content and URLs"""
+    def populate_database(self, incremental: bool = False, atomic: bool = False, resume: bool = True):
+        """Populate database with course content and URLs.
+
+        ``incremental`` writes only what changed since the previous sync, ``atomic`` writes a new
+        generation that replaces the visible one once complete, and ``resume`` lets an atomic sync
+        continue an unfinished one (see "LMS content sync" in the README).
+        Returns the (kind, course_id, unit_id) of the units an atomic sync could not fetch, their
+        courses keep the rows of the previous generation.
+        """
         if not self.token or not self.user_id or not self.moodle_user_id:
             raise ValueError("Moodle API token, user_id, and moodle_user_id must be set")
+        if incremental and atomic:
+            raise ValueError("incremental and atomic sync modes are mutually exclusive")
             
         try:
             connection = self.get_mysql_connection()
             cursor = connection.cursor()
-            
-            # Clear existing data for the user
-            cursor.execute("DELETE FROM pdf_urls WHERE user_id = %s", (self.user_id,))
-            cursor.execute("DELETE FROM discussion_urls WHERE user_id = %s", (self.user_id,))
-            connection.commit()
+
+            # Two syncs of one user would resume the same generation and insert every unit twice
+            locked = self._acquire_sync_lock(cursor)
+            if not locked:
+                raise SyncInProgressError(self.user_id)
+
+            # Without atomic mode the whole sync runs in one transaction, committed once at the end
+            connection.start_transaction()
+
+            active_generation, pending_generation = self.get_sync_state(cursor)
+            checkpoint = CrawlCheckpoint(cursor, self.user_id) if atomic else None
+            resuming = atomic and resume and pending_generation is not None
+            if resuming:
+                generation = pending_generation
+                done_courses, done_forums, forum_pages = checkpoint.load()
+            elif atomic:
+                generation = max(active_generation, pending_generation or 0) + 1
+                done_courses, done_forums, forum_pages = {}, set(), {}
+                self._begin_generation(cursor, generation)
+                checkpoint.clear()
+            else:
+                generation = active_generation
+                done_courses, done_forums, forum_pages = {}, set(), {}
+
+            files = ContentTableWriter(cursor, self.user_id, 'pdf_urls', 'pdf_url',
+                                       ('timemodified', 'filesize'), incremental, self.batch_size, generation)
+            discussions = ContentTableWriter(cursor, self.user_id, 'discussion_urls', 'discussion_url',
+                                             ('timemodified',), incremental, self.batch_size, generation)
+
+            # Clear existing data for the user, or load the previous snapshot to diff against,
+            # or keep the rows an interrupted sync already wrote
+            files.begin(resume=resuming)
+            discussions.begin(resume=resuming)
+            if atomic:
+                connection.commit()
 
             # Get courses for the specific user
-            params = {
-                'wstoken': self.token,
-                'moodlewsrestformat': 'json',
-                'wsfunction': 'core_enrol_get_users_courses',
-                'userid': self.moodle_user_id
-            }
-            
-            response = requests.get(f"{self.base_url}/webservice/rest/server.php", params=params)
-            response.raise_for_status()
-            
-            courses = response.json()
+            courses = self.get_client().get_users_courses(self.moodle_user_id, token=self.token)
             
-            for course in courses:
-                # Insert course
-                cursor.execute(
-                    "INSERT IGNORE INTO courses (course_id, course_name) VALUES (%s, %s)",
-                    (course['id'], course['fullname'])
+            for start in range(0, len(courses), self.batch_size):
+                insert_many(
+                    cursor, 'courses', ('course_id', 'course_name'),
+                    [(course['id'], course['fullname']) for course in courses[start:start + self.batch_size]],
+                    ignore=True
                 )
-                connection.commit()
-                
-                # Get course contents
-                content_params = {
-                    'wstoken': self.token,
-                    'moodlewsrestformat': 'json',
-                    'wsfunction': 'core_course_get_contents',
-                    'courseid': course['id']
-                }
-                
-                content_response = requests.get(f"{self.base_url}/webservice/rest/server.php", params=content_params)
-                content_response.raise_for_status()
-                
-                contents = content_response.json()
-                
-                for section in contents:
-                    for module in section.get('modules', []):
-                        # Process PDF files
-                        if 'contents' in module:
-                            for content in module['contents']:
-                                if content.get('type') == 'file' and content.get('filename', '').lower().endswith(('.pdf', '.docx', '.pptx', '.txt')):
-                                    file_url = f"{content['fileurl']}&token={self.token}"
-                                    cursor.execute(
-                                        "INSERT IGNORE INTO pdf_urls (course_id, user_id, pdf_url) VALUES (%s, %s, %s)",
-                                        (course['id'], self.user_id, file_url)
-                                    )
-                                    
-                        # Process forum discussions
-                        if module.get('modname') == 'forum':
-                            forum_id = module.get('instance')
-                            if forum_id:
-                                forum_params = {
-                                    'wstoken': self.token,
-                                    'moodlewsrestformat': 'json',
-                                    'wsfunction': 'mod_forum_get_forum_discussions',
-                                    'forumid': forum_id
-                                }
-                                
-                                forum_response = requests.get(f"{self.base_url}/webservice/rest/server.php", params=forum_params)
-                                if forum_response.status_code == 200:
-                                    discussions = forum_response.json()
-                                    if 'discussions' in discussions:
-                                        for discussion in discussions['discussions']:
-                                            discussion_url = f"{self.base_url}/mod/forum/discuss.php?d={discussion['discussion']}&token={self.token}"
-                                            cursor.execute(
-                                                "INSERT IGNORE INTO discussion_urls (course_id, user_id, discussion_url) VALUES (%s, %s, %s)",
-                                                (course['id'], self.user_id, discussion_url)
-                                            )
-                
-                connection.commit()
+
+            # Course contents and forum discussion pages are fetched concurrently,
+            # rows are buffered here as each response arrives
+            crawl = self.crawl_courses(courses, done_courses, done_forums, forum_pages)
+            failures = []
+            for kind, course_id, unit_id, result, next_page in crawl:
+                if isinstance(result, Exception):
+                    print(f"Error fetching {kind} {unit_id} of course {course_id}: {str(result)}")
+                    failures.append((kind, course_id, unit_id))
+                    continue
+                if kind == 'contents':
+                    files.write(self._file_rows(course_id, result))
+                else:
+                    discussions.write(self._discussion_rows(course_id, result))
+                if atomic:
+                    # Rows of the new generation are invisible to readers, so each finished unit
+                    # or forum page is committed together with its checkpoint
+                    files.flush()
+                    discussions.flush()
+                    if kind == 'contents':
+                        checkpoint.mark_course(course_id, self._forum_ids(result))
+                    else:
+                        checkpoint.mark_forum(unit_id, next_page)
+                    connection.commit()
+
+            if failures and not (atomic or incremental):
+                # A full refresh runs in one transaction, rolling it back keeps the previous rows
+                raise SyncIncompleteError(failures)
+
+            # Flush the remaining rows and drop rows that disappeared from Moodle since the previous sync,
+            # except in courses with a failed fetch, whose rows were not seen because they were not fetched
+            failed_contents = {course_id for kind, course_id, _ in failures if kind == 'contents'}
+            files.finish(keep_courses=failed_contents)
+            discussions.finish(keep_courses={course_id for _, course_id, _ in failures})
+            connection.commit()
+
+            if failures and not atomic:
+                # The next incremental sync fetches the failed units again
+                raise SyncIncompleteError(failures)
+            if atomic:
+                if failures:
+                    # A unit that keeps failing would otherwise hold back the whole generation forever,
+                    # its course keeps the rows readers see now and is fetched again by the next sync
+                    files.copy_courses(failed_contents, active_generation)
+                    discussions.copy_courses({course_id for _, course_id, _ in failures}, active_generation)
+                    connection.commit()
+                    print(f"Warning: {SyncIncompleteError(failures)}, their courses keep their previous content")
+                self._activate_generation(connection, cursor, generation)
+            return failures
                 
         except Exception as e:
             print(f"Error populating database: {str(e)}")
+            if 'connection' in locals() and connection.is_connected():
+                connection.rollback()
             raise
         finally:
+            if locals().get('locked') and connection.is_connected():
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (self._sync_lock_name(),))
+                cursor.fetchone()
             if 'cursor' in locals():
                 cursor.close()
             if 'connection' in locals() and connection.is_connected():
                 connection.close()
+            self.close()
+
+    def _sync_lock_name(self) -> str:
+        return f"lms_sync:{self.user_id}"
+
+    def _acquire_sync_lock(self, cursor) -> bool:
+        """Take the user's named MySQL lock without waiting, it is released when the connection closes at the latest"""
+        cursor.execute("SELECT GET_LOCK(%s, 0)", (self._sync_lock_name(),))
+        return cursor.fetchone()[0] == 1
+
+    def get_sync_state(self, cursor) -> Tuple[int, Optional[int]]:
+        """Return the generation readers currently see and the generation of an unfinished atomic sync"""
+        cursor.execute(
+            "SELECT active_generation, pending_generation FROM content_sync_state WHERE user_id = %s",
+            (self.user_id,)
+        )
+        row = cursor.fetchone()
+        return (row[0], row[1]) if row else (0, None)
+
+    def _begin_generation(self, cursor, generation: int):
+        cursor.execute("""
+            INSERT INTO content_sync_state (user_id, active_generation, pending_generation) VALUES (%s, 0, %s)
+            ON DUPLICATE KEY UPDATE pending_generation = VALUES(pending_generation)
+        """, (self.user_id, generation))
+
+    def _activate_generation(self, connection, cursor, generation: int):
+        """Atomically switch readers to ``generation`` and drop the rows of older generations"""
+        cursor.execute(
+            "UPDATE content_sync_state SET active_generation = %s, pending_generation = NULL WHERE user_id = %s",
+            (generation, self.user_id)
+        )
+        CrawlCheckpoint(cursor, self.user_id).clear()
+        connection.commit()
+
+        for table in ('pdf_urls', 'discussion_urls'):
+            cursor.execute(
+                f"DELETE FROM {table} WHERE user_id = %s AND generation <> %s",
+                (self.user_id, generation)
+            )
+        connection.commit()
+
+    def crawl_courses(self, courses: List[Dict], done_courses: Optional[Dict[int, List[int]]] = None,
+                      done_forums: Optional[set] = None,
+                      forum_pages: Optional[Dict[int, int]] = None) -> Iterator[Tuple[str, int, int, List[Dict], Optional[int]]]:
+        """Fetch course contents and forum discussions concurrently.
+
+        Yields (kind, course_id, unit_id, result, next_page) tuples in completion order, one per
+        course and per forum page; ``result`` is the exception of a transiently failed fetch.
+        Courses in ``done_courses`` and forums in ``done_forums`` are skipped, forums in
+        ``forum_pages`` continue from the given page.
+        """
+        done_courses = done_courses or {}
+        done_forums = done_forums or set()
+        forum_pages = forum_pages or {}
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+        def submit_forum_page(course_id, forum_id, page):
+            future = executor.submit(self._fetch_forum_discussions, forum_id, page)
+            pending[future] = ('discussions', course_id, forum_id, page)
+
+        def submit_forums(course_id, forum_ids):
+            for forum_id in forum_ids:
+                if forum_id not in done_forums:
+                    submit_forum_page(course_id, forum_id, forum_pages.get(forum_id, 0))
+
+        try:
+            pending = {}
+            for course in courses:
+                if course['id'] in done_courses:
+                    submit_forums(course['id'], done_courses[course['id']])
+                else:
+                    future = executor.submit(self._fetch_course_contents, course['id'])
+                    pending[future] = ('contents', course['id'], course['id'], None)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    kind, course_id, unit_id, page = pending.pop(future)
+                    next_page = None
+                    try:
+                        result = future.result()
+                    except (requests.RequestException, MoodleError) as e:
+                        if is_transient_error(e):
+                            yield kind, course_id, unit_id, e, None
+                            continue
+                        print(f"Skipping {kind} {unit_id} of course {course_id}: {str(e)}")
+                        result = []
+                    if kind == 'contents':
+                        submit_forums(course_id, self._forum_ids(result))
+                    elif len(result) >= self.forum_page_size:
+                        next_page = page + 1
+                        submit_forum_page(course_id, unit_id, next_page)
+                    yield kind, course_id, unit_id, result, next_page
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_client(self) -> MoodleClient:
+        """Return the pooled Moodle client, creating it on first use"""
+        if self.client is None:
+            self.client = MoodleClient(self.base_url, pool_size=self.max_concurrency)
+            self._owns_client = True
+        return self.client
+
+    def close(self):
+        """Close the Moodle client if this processor created it, a client passed in is left to its owner"""
+        if self._owns_client:
+            self.client.close()
+            self.client = None
+            self._owns_client = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _fetch_course_contents(self, course_id: int) -> List[Dict]:
+        def fetch():
+            return self.get_client().get_course_contents(course_id, token=self.token)
+
+        if self.fetch_cache is None:
+            return fetch()
+        # Every user fetches a course with per-user restrictions, looking up their roles and groups
+        # first would only add a call
+        restricted_key = ('restricted', course_id)
+        if self.fetch_cache.peek(restricted_key):
+            return fetch()
+        key = self._visibility_key(course_id)
+        if key is None:
+            return fetch()
+
+        fetched = []
+
+        def fetch_shared():
+            fetched.append(True)
+            return fetch()
+
+        contents = self.fetch_cache.get(('contents', course_id, key), fetch_shared)
+        if self._is_course_wide(contents):
+            return contents
+        self.fetch_cache.get(restricted_key, lambda: True)
+        # Contents another user fetched are only theirs when access to some of it depends on the user
+        return contents if fetched else fetch()
+
+    def _visibility_key(self, course_id: int) -> Optional[Tuple]:
+        """Roles and groups of the user in a course, or None when they could not be looked up.
+        Moodle filters course contents by role and group, so only users sharing both share
+        cached contents. Contents with other access restrictions are not shared, see _is_course_wide.
+        They are read from the user's own profile, fetched with the user's token: a participant list
+        fetched with another user's token leaves out the groups that user cannot see in
+        separate-groups courses, so users of different groups would get the same key.
+        """
+        try:
+            profile = self.get_client().get_course_user_profile(self.moodle_user_id, course_id, token=self.token)
+        except (requests.RequestException, MoodleError) as e:
+            print(f"Could not look up roles and groups of Moodle user {self.moodle_user_id} in course "
+                  f"{course_id}, its contents are not shared with other users: {e}")
+            return None
+        if profile is None:
+            return None
+        return self._role_group_key(profile)
+
+    @staticmethod
+    def _role_group_key(user: Dict) -> Tuple:
+        return (
+            tuple(sorted(role['roleid'] for role in user.get('roles', []))),
+            tuple(sorted(group['id'] for group in user.get('groups', [])))
+        )
+
+    def _fetch_forum_discussions(self, forum_id: int, page: int = 0) -> List[Dict]:
+        """Fetch one page of a forum's discussions.
+        Pages are not put in the fetch cache: each is written once and then dropped,
+        while a cycle-wide cache would keep every page of every forum until the cycle ends."""
+        return self.get_client().get_forum_discussions(
+            forum_id, token=self.token, page=page, per_page=self.forum_page_size
+        )
+
+    @staticmethod
+    def _is_course_wide(contents: List[Dict]) -> bool:
+        """Whether every user with the same roles and groups gets the same contents.
+        Completion, grade and date restrictions are evaluated per user, Moodle then reports the
+        section or module as restricted and sets uservisible and its files for that user only."""
+        for section in contents:
+            for item in [section] + section.get('modules', []):
+                if item.get('availability') or item.get('availabilityinfo') or not item.get('uservisible', True):
+                    return False
+        return True
+
+    @staticmethod
+    def _forum_ids(contents: List[Dict]) -> List[int]:
+        # Forums hidden from the user are listed with uservisible false, their discussions cannot be fetched
+        return [
+            module['instance']
+            for section in contents
+            for module in section.get('modules', [])
+            if module.get('modname') == 'forum' and module.get('instance') and module.get('uservisible', True)
+        ]
+
+    def _file_rows(self, course_id: int, contents: List[Dict]) -> List[Tuple]:
+        rows = []
+        for section in contents:
+            for module in section.get('modules', []):
+                for content in module.get('contents', []):
+                    if content.get('type') == 'file' and content.get('filename', '').lower().endswith(SUPPORTED_EXTENSIONS):
+                        file_url = f"{content['fileurl']}&token={self.token}"
+                        rows.append((course_id, self.user_id, file_url,
+                                     content.get('timemodified'), content.get('filesize')))
+        return rows
+
+    def _discussion_rows(self, course_id: int, discussions: List[Dict]) -> List[Tuple]:
+        return [
+            (course_id, self.user_id,
+             f"{self.base_url}/mod/forum/discuss.php?d={discussion['discussion']}&token={self.token}",
+             discussion.get('timemodified'))
+            for discussion in discussions
+        ]
 
     def fetch_urls(self) -> Tuple[List[Dict], List[Dict]]:
         """Fetch PDF and discussion URLs from MySQL"""
@@ -125,11 +467,11 @@ class ContentProcessor:
         
         # Fetch PDF URLs
         cursor.execute("""
-            SELECT p.pdf_url, c.course_name, c.course_id 
+            SELECT p.pdf_url, p.timemodified, p.filesize, c.course_name, c.course_id 
             FROM pdf_urls p 
             JOIN courses c ON p.course_id = c.course_id
-            WHERE p.user_id = %s
-        """, (self.user_id,))
+            WHERE p.user_id = %s AND p.generation = {ACTIVE_GENERATION}
+        """.format(ACTIVE_GENERATION=ACTIVE_GENERATION_SQL), (self.user_id, self.user_id))
         pdf_urls = cursor.fetchall()
         
         # Fetch discussion URLs
@@ -137,8 +479,8 @@ class ContentProcessor:
             SELECT d.discussion_url, c.course_name, c.course_id 
             FROM discussion_urls d 
             JOIN courses c ON d.course_id = c.course_id
-            WHERE d.user_id = %s
-        """, (self.user_id,))
+            WHERE d.user_id = %s AND d.generation = {ACTIVE_GENERATION}
+        """.format(ACTIVE_GENERATION=ACTIVE_GENERATION_SQL), (self.user_id, self.user_id))
         discussion_urls = cursor.fetchall()
         
         cursor.close()
@@ -146,6 +488,178 @@ class ContentProcessor:
         
         return pdf_urls, discussion_urls
 
+def insert_many(cursor, table: str, columns: Tuple[str, ...], rows: List[Tuple], ignore: bool = False,
+                on_duplicate: str = ''):
+    """Write rows with a single multi-row INSERT ... VALUES statement"""
+    if not rows:
+        return
+    placeholders = f"({', '.join(['%s'] * len(columns))})"
+    cursor.execute(
+        f"INSERT {'IGNORE ' if ignore else ''}INTO {table} ({', '.join(columns)}) "
+        f"VALUES {', '.join([placeholders] * len(rows))}{on_duplicate}",
+        tuple(value for row in rows for value in row)
+    )
+
+class ContentTableWriter:
+    """Buffered writer of one per-user content table (pdf_urls, discussion_urls) within a sync generation"""
+
+    def __init__(self, cursor, user_id, table: str, url_column: str, version_columns: Tuple[str, ...],
+                 incremental: bool = False, batch_size: int = 500, generation: int = 0):
+        self.cursor = cursor
+        self.user_id = user_id
+        self.table = table
+        self.url_column = url_column
+        self.version_columns = version_columns
+        self.columns = ('course_id', 'user_id', url_column) + version_columns + ('generation',)
+        self.generation = generation
+        self.incremental = incremental
+        self.batch_size = batch_size
+        self.snapshot = {}  # url -> (row id, (course_id, *versions)) of rows not seen yet
+        self.stale_ids = []
+        self.seen = set()
+        self.pending_inserts = []
+        self.pending_updates = []
+
+    def begin(self, resume: bool = False):
+        """Clear the user's rows, or load them as the snapshot to diff against.
+
+        With ``resume`` the rows an interrupted sync already wrote are kept and only remembered as seen.
+        """
+        if resume:
+            self.cursor.execute(
+                f"SELECT {self.url_column} FROM {self.table} WHERE user_id = %s AND generation = %s",
+                (self.user_id, self.generation)
+            )
+            self.seen = {row[0] for row in self.cursor.fetchall()}
+            return
+
+        if not self.incremental:
+            self.cursor.execute(
+                f"DELETE FROM {self.table} WHERE user_id = %s AND generation = %s",
+                (self.user_id, self.generation)
+            )
+            return
+
+        self.cursor.execute(
+            f"SELECT id, {self.url_column}, course_id, {', '.join(self.version_columns)} "
+            f"FROM {self.table} WHERE user_id = %s AND generation = %s",
+            (self.user_id, self.generation)
+        )
+        for row in self.cursor.fetchall():
+            if row[1] in self.snapshot:
+                self.stale_ids.append(row[0])  # duplicate left over from a full sync
+            else:
+                self.snapshot[row[1]] = (row[0], tuple(row[2:]))
+
+    def write(self, rows: List[Tuple]):
+        for row in rows:
+            url = row[2]
+            if url in self.seen:
+                continue
+            self.seen.add(url)
+
+            previous = self.snapshot.pop(url, None)
+            if previous is None:
+                self.pending_inserts.append(tuple(row) + (self.generation,))
+            elif previous[1] != (row[0],) + tuple(row[3:]):
+                self.pending_updates.append((previous[0],) + tuple(row) + (self.generation,))
+
+            if len(self.pending_inserts) + len(self.pending_updates) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """Send buffered inserts and updates to the server"""
+        insert_many(self.cursor, self.table, self.columns, self.pending_inserts, ignore=True)
+        # Updates are keyed by the primary key, so a multi-row upsert updates them in one statement
+        insert_many(
+            self.cursor, self.table, ('id',) + self.columns, self.pending_updates,
+            on_duplicate=" ON DUPLICATE KEY UPDATE " + ', '.join(
+                f"{column} = VALUES({column})" for column in ('course_id',) + self.version_columns
+            )
+        )
+        self.pending_inserts = []
+        self.pending_updates = []
+
+    def finish(self, keep_courses: Optional[set] = None):
+        """Flush pending writes and delete rows of the previous snapshot not seen in this sync.
+
+        Unseen rows of the courses in ``keep_courses`` are kept, for courses that could not be fully fetched.
+        """
+        self.flush()
+        keep_courses = keep_courses or set()
+        stale_ids = self.stale_ids + [
+            row_id for row_id, versions in self.snapshot.values() if versions[0] not in keep_courses
+        ]
+        for start in range(0, len(stale_ids), self.batch_size):
+            batch = stale_ids[start:start + self.batch_size]
+            self.cursor.execute(
+                f"DELETE FROM {self.table} WHERE id IN ({', '.join(['%s'] * len(batch))})",
+                tuple(batch)
+            )
+        self.snapshot = {}
+        self.stale_ids = []
+
+    def copy_courses(self, course_ids: set, from_generation: int):
+        """Copy the rows of ``course_ids`` from another generation into this one, except the URLs
+        this generation already has."""
+        if not course_ids:
+            return
+        columns = self.columns[:-1]
+        course_ids = sorted(course_ids)
+        self.cursor.execute(f"""
+            INSERT INTO {self.table} ({', '.join(columns)}, generation)
+            SELECT {', '.join(f'active.{column}' for column in columns)}, %s
+            FROM {self.table} active
+            LEFT JOIN {self.table} pending
+                ON pending.user_id = active.user_id AND pending.generation = %s
+                AND pending.{self.url_column} = active.{self.url_column}
+            WHERE active.user_id = %s AND active.generation = %s
+                AND active.course_id IN ({', '.join(['%s'] * len(course_ids))}) AND pending.id IS NULL
+        """, (self.generation, self.generation, self.user_id, from_generation, *course_ids))
+
+class CrawlCheckpoint:
+    """Finished courses and forums of a user's atomic sync, stored in crawl_checkpoints"""
+
+    def __init__(self, cursor, user_id):
+        self.cursor = cursor
+        self.user_id = user_id
+
+    def load(self) -> Tuple[Dict[int, List[int]], set, Dict[int, int]]:
+        """Return the finished courses (mapped to their forum ids), the finished forums,
+        and the next page of forums that were interrupted midway"""
+        self.cursor.execute(
+            "SELECT unit, completed, cursor_value, forum_ids FROM crawl_checkpoints WHERE user_id = %s",
+            (self.user_id,)
+        )
+        done_courses, done_forums, forum_pages = {}, set(), {}
+        for unit, completed, cursor_value, forum_ids in self.cursor.fetchall():
+            kind, unit_id = unit.split(':', 1)
+            if kind == 'course':
+                done_courses[int(unit_id)] = json.loads(forum_ids or '[]')
+            elif completed:
+                done_forums.add(int(unit_id))
+            else:
+                forum_pages[int(unit_id)] = cursor_value
+        return done_courses, done_forums, forum_pages
+
+    def mark_course(self, course_id: int, forum_ids: List[int]):
+        self._save(f"course:{course_id}", completed=True, forum_ids=json.dumps(forum_ids))
+
+    def mark_forum(self, forum_id: int, next_page: Optional[int] = None):
+        """Record a finished forum, or the next page to fetch of an unfinished one"""
+        self._save(f"forum:{forum_id}", completed=next_page is None, cursor_value=next_page or 0)
+
+    def _save(self, unit: str, completed: bool, cursor_value: int = 0, forum_ids: Optional[str] = None):
+        self.cursor.execute("""
+            INSERT INTO crawl_checkpoints (user_id, unit, cursor_value, completed, forum_ids)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE cursor_value = VALUES(cursor_value), completed = VALUES(completed),
+                                    forum_ids = VALUES(forum_ids)
+        """, (self.user_id, unit, cursor_value, completed, forum_ids))
+
+    def clear(self):
+        self.cursor.execute("DELETE FROM crawl_checkpoints WHERE user_id = %s", (self.user_id,))
+
 def main():
     processor = ContentProcessor()
     
@@ -156,7 +670,7 @@ def main():
     
     # Populate database with course content
     print("Populating database with course content...")
-    processor.populate_database()
+    processor.populate_database(atomic=True)
     
     # Fetch URLs from MySQL
     print("\nFetching URLs from MySQL...")
@@ -48,6 +48,12 @@ try:
     cursor.execute("DROP TABLE IF EXISTS discussion_urls;")
     print("Dropped existing 'discussion_urls' table.")
 
+    cursor.execute("DROP TABLE IF EXISTS crawl_checkpoints;")
+    print("Dropped existing 'crawl_checkpoints' table.")
+
+    cursor.execute("DROP TABLE IF EXISTS content_sync_state;")
+    print("Dropped existing 'content_sync_state' table.")
+
     cursor.execute("DROP TABLE IF EXISTS course_urls;") # Assuming this might also have FKs
     print("Dropped existing 'course_urls' table.")
 
@@ -97,6 +103,10 @@ try:
         course_id INT NOT NULL,
         user_id INT NOT NULL,
         pdf_url TEXT,
+        timemodified INT,
+        filesize BIGINT,
+        generation INT NOT NULL DEFAULT 0,
+        INDEX idx_pdf_urls_user_generation (user_id, generation),
         FOREIGN KEY (course_id) REFERENCES courses(course_id),
         FOREIGN KEY (user_id) REFERENCES users(user_id)
     );
@@ -113,6 +123,9 @@ try:
         course_id INT NOT NULL,
         user_id INT NOT NULL,
         discussion_url TEXT,
+        timemodified INT,
+        generation INT NOT NULL DEFAULT 0,
+        INDEX idx_discussion_urls_user_generation (user_id, generation),
         FOREIGN KEY (course_id) REFERENCES courses(course_id),
         FOREIGN KEY (user_id) REFERENCES users(user_id)
     );
@@ -122,6 +135,39 @@ try:
     cursor.execute(create_discussion_urls_table_query)
     print("Table 'discussion_urls' is ready.")
 
+    # Define content_sync_state table creation query
+    # Rows of pdf_urls/discussion_urls are only visible when their generation is the user's active one
+    create_content_sync_state_table_query = """
+    CREATE TABLE IF NOT EXISTS content_sync_state (
+        user_id INT PRIMARY KEY,
+        active_generation INT NOT NULL DEFAULT 0,
+        pending_generation INT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+    """
+
+    # Execute the table creation query
+    cursor.execute(create_content_sync_state_table_query)
+    print("Table 'content_sync_state' is ready.")
+
+    # Define crawl_checkpoints table creation query
+    # Progress of an unfinished atomic sync, used to resume it after a failure
+    create_crawl_checkpoints_table_query = """
+    CREATE TABLE IF NOT EXISTS crawl_checkpoints (
+        user_id INT NOT NULL,
+        unit VARCHAR(64) NOT NULL,
+        cursor_value INT NOT NULL DEFAULT 0,
+        completed BOOLEAN NOT NULL DEFAULT FALSE,
+        forum_ids TEXT,
+        PRIMARY KEY (user_id, unit),
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+    """
+
+    # Execute the table creation query
+    cursor.execute(create_crawl_checkpoints_table_query)
+    print("Table 'crawl_checkpoints' is ready.")
+
 
     # Load user_key from .env
     moodle_user_key = os.getenv('MOODLE_USER_KEY')
@@ -0,0 +1,96 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import List, Dict, Optional
+
+DEFAULT_TIMEOUT = (5, 30)  # (connect, read) seconds
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class MoodleError(Exception):
+    """Raised when Moodle answers a web service call with an exception payload"""
+
+    def __init__(self, wsfunction: str, payload: Dict):
+        self.wsfunction = wsfunction
+        self.errorcode = payload.get('errorcode')
+        super().__init__(f"{wsfunction} failed: {payload.get('message', payload.get('errorcode'))}")
+
+
+class MoodleClient:
+    """
+    Moodle REST web service client.
+    Keeps a pooled keep-alive session so TCP/TLS handshakes are paid once per host,
+    and retries 429/5xx responses with exponential backoff.
+    """
+
+    def __init__(self, base_url: str, token: Optional[str] = None, timeout=DEFAULT_TIMEOUT,
+                 max_retries: int = 3, backoff_factor: float = 0.5, pool_size: int = 10,
+                 pool_block: bool = False):
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        # With pool_block the pool size is a hard cap on concurrent requests to Moodle
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry,
+                              pool_block=pool_block)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def call(self, wsfunction: str, token: Optional[str] = None, **params):
+        """Call a web service function and return the decoded JSON response"""
+        params.update({
+            'wstoken': token or self.token,
+            'moodlewsrestformat': 'json',
+            'wsfunction': wsfunction
+        })
+        response = self.session.get(
+            f"{self.base_url}/webservice/rest/server.php",
+            params=params,
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        data = response.json()
+        if isinstance(data, dict) and 'exception' in data:
+            raise MoodleError(wsfunction, data)
+        return data
+
+    def get_users_courses(self, user_id, token: Optional[str] = None) -> List[Dict]:
+        return self.call('core_enrol_get_users_courses', token=token, userid=user_id)
+
+    def get_course_contents(self, course_id: int, token: Optional[str] = None) -> List[Dict]:
+        return self.call('core_course_get_contents', token=token, courseid=course_id)
+
+    def get_course_user_profile(self, user_id, course_id: int, token: Optional[str] = None) -> Optional[Dict]:
+        """Profile of a user in a course, including their roles and groups there.
+        Moodle keys the requested courses by user id, so a user listed for several courses in one
+        call only gets the profile of the last one; each course is looked up in its own call."""
+        profiles = self.call('core_user_get_course_user_profiles', token=token, **{
+            'userlist[0][userid]': user_id,
+            'userlist[0][courseid]': course_id
+        })
+        return profiles[0] if profiles else None
+
+    def get_forum_discussions(self, forum_id: int, token: Optional[str] = None, page: int = -1,
+                              per_page: int = 0) -> List[Dict]:
+        """Fetch one page of a forum's discussions, the default page of -1 returns all of them"""
+        data = self.call('mod_forum_get_forum_discussions', token=token, forumid=forum_id,
+                         page=page, perpage=per_page)
+        return data.get('discussions', [])
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,76 @@
+import os
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+import numpy as np
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire ``ttl`` seconds after they were stored"""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache_size = int(os.getenv('QUERY_CACHE_SIZE', '1024'))
+_cache_ttl = float(os.getenv('QUERY_CACHE_TTL_SECONDS', '3600'))
+
+# (model name, query text) -> query embedding
+query_embeddings = TTLCache(_cache_size, _cache_ttl)
+# (collection key, collection version, query vector hash, n_results) -> query results
+query_results = TTLCache(_cache_size, _cache_ttl)
+
+# Bumped on every write to a collection, results cached under an older version are never read again
+_collection_versions: Dict[Tuple[Optional[str], str], int] = {}
+_versions_lock = threading.Lock()
+
+
+def collection_key(path: Optional[str], collection_name: str) -> Tuple[Optional[str], str]:
+    return (os.path.abspath(path) if path is not None else None, collection_name)
+
+
+def collection_version(path: Optional[str], collection_name: str) -> int:
+    return _collection_versions.get(collection_key(path, collection_name), 0)
+
+
+def invalidate_collection(path: Optional[str], collection_name: str):
+    """Forget the cached results of a collection, called by every write to it in this process"""
+    key = collection_key(path, collection_name)
+    with _versions_lock:
+        _collection_versions[key] = _collection_versions.get(key, 0) + 1
+
+
+def vector_hash(vector) -> str:
+    return hashlib.sha1(np.asarray(vector, dtype=np.float32).tobytes()).hexdigest()
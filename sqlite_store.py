@@ -0,0 +1,15 @@
+import sqlite3
+from contextlib import contextmanager
+
+
+@contextmanager
+def connect(path: str, timeout: float = 30):
+    """Open a SQLite database for one operation: the block runs in a transaction, committed when it
+    succeeds, and the connection is closed after it. SQLite connections cannot be shared between
+    threads, so the stores built on this one open a connection per operation."""
+    connection = sqlite3.connect(path, timeout=timeout)
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
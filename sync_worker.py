@@ -0,0 +1,104 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict
+from dotenv import load_dotenv
+from lms_access import ContentProcessor, FetchCache, SyncInProgressError
+from moodle_client import MoodleClient
+
+# Load environment variables
+load_dotenv()
+
+
+class SyncScheduler:
+    """
+    Background worker that periodically syncs the LMS content of every user in the users table.
+    All users of a cycle share one Moodle client and one FetchCache, so a course's contents are
+    fetched once per cycle and fanned out to every enrolled user with the same roles and groups,
+    unless some of its sections or activities have access restrictions evaluated per user.
+    """
+
+    def __init__(self, interval: int = 3600, max_users: int = 4, max_requests: int = 8, mode: str = 'atomic'):
+        self.interval = interval
+        self.max_users = max_users
+        self.max_requests = max_requests
+        self.mode = mode
+        # pool_block turns the pool size into a global cap on in-flight Moodle requests
+        self.client = MoodleClient(os.getenv('MOODLE_BASE_URL'), pool_size=max_requests, pool_block=True)
+
+    def load_users(self) -> List[Dict]:
+        """Fetch the users that have Moodle credentials"""
+        connection = ContentProcessor().get_mysql_connection()
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute("""
+            SELECT user_id, moodle_user_key, moodle_user_id
+            FROM users
+            WHERE moodle_user_key IS NOT NULL AND moodle_user_id IS NOT NULL
+        """)
+        users = cursor.fetchall()
+        cursor.close()
+        connection.close()
+        return users
+
+    def sync_user(self, user: Dict, fetch_cache: FetchCache):
+        processor = ContentProcessor(max_concurrency=self.max_requests, client=self.client, fetch_cache=fetch_cache)
+        processor.token = user['moodle_user_key']
+        processor.user_id = user['user_id']
+        processor.moodle_user_id = user['moodle_user_id']
+        processor.populate_database(incremental=self.mode == 'incremental', atomic=self.mode == 'atomic')
+
+    def run_cycle(self):
+        """Sync every user once"""
+        users = self.load_users()
+        fetch_cache = FetchCache()
+        started = time.time()
+        failures = skipped = 0
+
+        with ThreadPoolExecutor(max_workers=self.max_users) as executor:
+            futures = {executor.submit(self.sync_user, user, fetch_cache): user for user in users}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except SyncInProgressError as e:
+                    # Synced from the app meanwhile, the next cycle picks the user up again
+                    skipped += 1
+                    print(f"Skipped user {futures[future]['user_id']}: {str(e)}")
+                except Exception as e:
+                    failures += 1
+                    print(f"Sync failed for user {futures[future]['user_id']}: {str(e)}")
+
+        print(f"Synced {len(users) - failures - skipped}/{len(users)} users ({skipped} already syncing) "
+              f"in {time.time() - started:.1f}s")
+
+    def run_forever(self):
+        while True:
+            started = time.time()
+            try:
+                self.run_cycle()
+            except Exception as e:
+                print(f"Sync cycle failed: {str(e)}")
+            time.sleep(max(0, self.interval - (time.time() - started)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Periodically sync LMS content for all users")
+    parser.add_argument('--interval', type=int, default=int(os.getenv('SYNC_INTERVAL_SECONDS', '3600')),
+                        help="Seconds between the starts of two sync cycles")
+    parser.add_argument('--max-users', type=int, default=int(os.getenv('SYNC_MAX_USERS', '4')),
+                        help="Number of users synced in parallel")
+    parser.add_argument('--max-requests', type=int, default=int(os.getenv('MOODLE_MAX_CONCURRENCY', '8')),
+                        help="Maximum number of concurrent Moodle requests")
+    parser.add_argument('--mode', choices=['incremental', 'atomic', 'full'], default='atomic',
+                        help="atomic syncs are checkpointed and resume after a failure")
+    parser.add_argument('--once', action='store_true', help="Run a single cycle and exit")
+    args = parser.parse_args()
+
+    scheduler = SyncScheduler(args.interval, args.max_users, args.max_requests, args.mode)
+    if args.once:
+        scheduler.run_cycle()
+    else:
+        scheduler.run_forever()
+
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,26 @@
 """
-from chromadb import PersistentClient
-from chromadb.config import Settings
+import chroma_store
 
 def list_chroma_collections(chromaDB_path):
-    # Connect to the ChromaDB instance
-    client = PersistentClient(
-        path=chromaDB_path,
-        settings=Settings()
-    )
-    
     # List all collections
-    collections = client.list_collections()
-    if not collections:
+    collection_names = chroma_store.list_collection_names(chromaDB_path)
+    if not collection_names:
         print("No collections found in ChromaDB.")
     else:
         print("Collections in ChromaDB:")
-        for collection in collections:
-            print(f"- {collection.name}")
+        for collection_name in collection_names:
+            print(f"- {collection_name}")
 
 if __name__ == "__main__":
     chromaDB_path = "./ChromaDbPersistent"  # Path to your ChromaDB storage
     list_chroma_collections(chromaDB_path)
 """
-from chromadb import PersistentClient
-from chromadb.config import Settings
+import chroma_store
 
 def list_collection_items(chromaDB_path, collection_name):
-    # Connect to the ChromaDB instance
-    client = PersistentClient(
-        path=chromaDB_path,
-        settings=Settings()
-    )
-    
     # Access the specified collection
     try:
-        collection = client.get_collection(collection_name)
+        collection = chroma_store.get_collection(chromaDB_path, collection_name, create=False)
     except Exception as e:
         print(f"Error accessing collection '{collection_name}': {e}")
         return
@@ -0,0 +1,112 @@
+"""
+Regression tests of the chunking rewrites: file_processor.chunk_text and RAG.TokenSplitter must
+keep producing the chunk boundaries of the implementations they replaced.
+Run with: python -m pytest test_chunking.py
+"""
+import random
+import pytest
+from file_processor import chunk_text, iter_chunk_spans
+from RAG import TokenSplitter
+
+
+def reference_chunk_text(text, chunk_size=1500, overlap=100):
+    """The word-list implementation chunk_text replaced"""
+    words = text.split()
+    chunks = []
+    start = 0
+    while start < len(words):
+        end = start + chunk_size
+        if end < len(words):
+            overlap_start = end - overlap
+            overlap_text = ' '.join(words[overlap_start:end])
+            last_period = overlap_text.rfind('.')
+            if last_period != -1:
+                end = overlap_start + last_period + 1
+        else:
+            end = len(words)
+        chunks.append(' '.join(words[start:end]))
+        start = end - overlap if end < len(words) else end
+    return chunks
+
+
+def reference_split_text_on_tokens(tokenizer, text, tokens_per_chunk, chunk_overlap):
+    """LangChain's split_text_on_tokens, used by SentenceTransformersTokenTextSplitter"""
+    input_ids = tokenizer.encode(text)
+    splits = []
+    start_idx = 0
+    cur_idx = min(start_idx + tokens_per_chunk, len(input_ids))
+    chunk_ids = input_ids[start_idx:cur_idx]
+    while start_idx < len(input_ids):
+        splits.append(tokenizer.decode(chunk_ids))
+        if cur_idx == len(input_ids):
+            break
+        start_idx += tokens_per_chunk - chunk_overlap
+        cur_idx = min(start_idx + tokens_per_chunk, len(input_ids))
+        chunk_ids = input_ids[start_idx:cur_idx]
+    return splits
+
+
+def fixed_texts(count, seed):
+    """Texts mixing sentence ends, runs of whitespace and unusual separators, always the same for a seed"""
+    rng = random.Random(seed)
+    pieces = ['a', 'bb', 'c.', 'd.e', '...', 'x\x1cy', 'end.', 'q', 'ödev.', '　']
+    separators = [' ', '  ', '\n', '\t', '']
+    return [
+        ''.join(rng.choice(pieces) + rng.choice(separators) for _ in range(rng.randint(0, 200)))
+        for _ in range(count)
+    ]
+
+
+CHUNK_SETTINGS = [(2, 0), (5, 1), (10, 3), (17, 8), (40, 20), (1500, 100)]
+
+
+@pytest.mark.parametrize('chunk_size, overlap', CHUNK_SETTINGS)
+def test_chunk_text_matches_reference(chunk_size, overlap):
+    for text in fixed_texts(200, seed=chunk_size):
+        assert chunk_text(text, chunk_size, overlap) == reference_chunk_text(text, chunk_size, overlap)
+
+
+def test_chunk_text_lone_surrogates():
+    text = "a \ud800 b. \udfff\n c d"
+    for chunk_size, overlap in CHUNK_SETTINGS:
+        assert chunk_text(text, chunk_size, overlap) == reference_chunk_text(text, chunk_size, overlap)
+
+
+def test_chunk_text_long_document():
+    text = ' '.join(f"word{i}." if i % 37 == 0 else f"w{i}" for i in range(20000))
+    assert chunk_text(text, 1500, 100) == reference_chunk_text(text, 1500, 100)
+
+
+@pytest.mark.parametrize('chunk_size, overlap', CHUNK_SETTINGS)
+def test_chunk_spans_cover_their_chunks(chunk_size, overlap):
+    for text in fixed_texts(50, seed=chunk_size):
+        for chunk, start, end in iter_chunk_spans(text, chunk_size, overlap):
+            assert ' '.join(text[start:end].split()) == chunk
+
+
+class CharacterTokenizer:
+    """One token per character, enough to check where token windows start and stop"""
+
+    def __call__(self, texts, **kwargs):
+        return {'input_ids': [self.encode(text) for text in texts]}
+
+    def encode(self, text):
+        return [ord(character) for character in text]
+
+    def decode(self, ids):
+        return ''.join(map(chr, ids))
+
+    def batch_decode(self, sequences):
+        return [self.decode(ids) for ids in sequences]
+
+
+@pytest.mark.parametrize('tokens_per_chunk, chunk_overlap', [(1, 0), (4, 0), (4, 3), (7, 2), (128, 0), (128, 16)])
+def test_token_splitter_matches_reference(monkeypatch, tokens_per_chunk, chunk_overlap):
+    tokenizer = CharacterTokenizer()
+    monkeypatch.setattr(TokenSplitter, 'get_tokenizer', staticmethod(lambda model_name: (tokenizer, 512)))
+    splitter = TokenSplitter('model', chunk_overlap, tokens_per_chunk)
+
+    texts = [''] + fixed_texts(100, seed=tokens_per_chunk) + ['x' * 1000]
+    assert splitter.split_texts(texts) == [
+        reference_split_text_on_tokens(tokenizer, text, tokens_per_chunk, chunk_overlap) for text in texts
+    ]
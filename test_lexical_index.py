@@ -0,0 +1,84 @@
+"""
+Tests of the segmented BM25 index: tombstones, tier merges and reopening an index from disk.
+Run with: python -m pytest test_lexical_index.py
+"""
+import pytest
+import lexical_index
+from lexical_index import LexicalIndex, MERGE_FACTOR
+
+TEXTS = {
+    'a': 'Lecture notes on sorting algorithms: quicksort and mergesort',
+    'b': 'Homework HW3 covers graph algorithms and shortest paths',
+    'c': 'Midterm exam covers sorting, hashing and graph search',
+    'd': 'Syllabus: grading, attendance and the final exam',
+    'e': 'Lab 2 implements hashing with open addressing',
+    'f': 'Office hours are held after the lecture',
+    'g': 'Quicksort partitions around a pivot, mergesort merges sorted halves',
+    'h': 'The final exam covers every lecture after the midterm',
+}
+
+
+def add_one_by_one(index, ids):
+    for chunk_id in ids:
+        index.add([chunk_id], [TEXTS[chunk_id]])
+
+
+def ranked(index, query):
+    return [(chunk_id, pytest.approx(score)) for chunk_id, score in index.search(query, n_results=len(TEXTS))]
+
+
+def test_deleted_chunk_can_be_added_again_in_a_later_segment(tmp_path):
+    index = LexicalIndex(str(tmp_path))
+    index.add(['a', 'b'], [TEXTS['a'], TEXTS['b']])
+    index.delete(['a'])
+    assert [chunk_id for chunk_id, _ in index.search('quicksort')] == []
+
+    index.add(['a'], ['Lecture notes on hashing'])
+    assert len(index) == 2
+    # The tombstone hides the old version in the first segment, not the new one
+    assert [chunk_id for chunk_id, _ in index.search('quicksort')] == []
+    assert [chunk_id for chunk_id, _ in index.search('hashing')] == ['a']
+
+
+def test_merge_prunes_tombstones_of_merged_segments(tmp_path):
+    index = LexicalIndex(str(tmp_path))
+    index.add(['a'], [TEXTS['a']])
+    index.delete(['a'])
+    assert index.manifest['tombstones'] == {'a': 0}
+
+    # The emptied first segment is one of the MERGE_FACTOR smallest segments merged here
+    add_one_by_one(index, list(TEXTS)[1:MERGE_FACTOR])
+    assert index.manifest['segments'] == [MERGE_FACTOR]
+    assert index.manifest['tombstones'] == {}
+    assert len(index) == MERGE_FACTOR - 1
+    assert 'a' not in {chunk_id for chunk_id, _ in index.search('quicksort mergesort lecture')}
+
+    index.add(['a'], [TEXTS['a']])
+    assert index.search('mergesort')[0][0] == 'a'
+
+
+def test_scores_do_not_change_when_segments_are_merged(tmp_path, monkeypatch):
+    merged = LexicalIndex(str(tmp_path / 'merged'))
+    add_one_by_one(merged, TEXTS)
+    assert len(merged.manifest['segments']) == 1
+
+    monkeypatch.setattr(lexical_index, 'MERGE_FACTOR', len(TEXTS) + 1)
+    unmerged = LexicalIndex(str(tmp_path / 'unmerged'))
+    add_one_by_one(unmerged, TEXTS)
+    assert len(unmerged.manifest['segments']) == len(TEXTS)
+
+    for query in ('sorting algorithms', 'final exam', 'graph', 'lecture hashing'):
+        assert ranked(merged, query) == ranked(unmerged, query)
+
+
+def test_reopened_index_matches_the_one_that_wrote_it(tmp_path):
+    index = LexicalIndex(str(tmp_path))
+    add_one_by_one(index, TEXTS)
+    index.delete(['c', 'g'])
+    index.add(['c'], ['Midterm exam moved to week 9'])
+
+    reopened = LexicalIndex(str(tmp_path))
+    assert len(reopened) == len(index) == len(TEXTS) - 1
+    assert reopened.total_length == index.total_length
+    for query in ('midterm exam', 'quicksort', 'graph algorithms'):
+        assert ranked(reopened, query) == ranked(index, query)
@@ -0,0 +1,431 @@
+"""
+Tests of the Moodle crawl against a fake Moodle that answers web service calls the way the real
+one does, without a network or a database.
+Run with: python -m pytest test_lms_access.py
+"""
+import re
+import pytest
+from lms_access import ContentProcessor, FetchCache, SyncInProgressError, SyncIncompleteError, is_transient_error
+from moodle_client import MoodleClient, MoodleError
+
+
+class FakeMoodle(MoodleClient):
+    """
+    Answers web service calls from in-memory data. ``memberships`` maps (user id, course id) to the
+    (role ids, group ids) of the user in the course, ``contents`` maps a course id to its sections.
+    Functions in ``refused`` fail with a nopermissions exception.
+    """
+
+    def __init__(self, memberships, contents=None, refused=()):
+        super().__init__('https://moodle.test')
+        self.memberships = memberships
+        self.contents = contents or {}
+        self.refused = set(refused)
+        self.calls = []
+        # Called before answering a course contents request, to run something while a crawl is under way
+        self.on_contents = None
+
+    def call(self, wsfunction, token=None, **params):
+        self.calls.append((wsfunction, token, params))
+        if wsfunction in self.refused:
+            raise MoodleError(wsfunction, {'exception': 'required_capability_exception', 'errorcode': 'nopermissions'})
+        if wsfunction == 'core_user_get_course_user_profiles':
+            # Like Moodle, the requested course is stored under the user id, a later entry
+            # for the same user replaces an earlier one
+            course_ids = {}
+            i = 0
+            while f'userlist[{i}][userid]' in params:
+                course_ids[params[f'userlist[{i}][userid]']] = params[f'userlist[{i}][courseid]']
+                i += 1
+            profiles = []
+            for user_id, course_id in course_ids.items():
+                if (user_id, course_id) not in self.memberships:
+                    continue
+                profiles.append(dict(self.user_details(user_id, course_id), enrolledcourses=[{'id': course_id}]))
+            return profiles
+        if wsfunction == 'core_enrol_get_users_courses':
+            return [
+                {'id': course_id, 'fullname': f'Course {course_id}'}
+                for user_id, course_id in self.memberships if user_id == params['userid']
+            ]
+        if wsfunction == 'core_course_get_contents':
+            if self.on_contents is not None:
+                self.on_contents()
+            contents = self.contents[params['courseid']]
+            if isinstance(contents, Exception):
+                raise contents
+            return contents
+        raise AssertionError(f"Unexpected call to {wsfunction}")
+
+    def user_details(self, user_id, course_id):
+        role_ids, group_ids = self.memberships[user_id, course_id]
+        return {
+            'id': user_id,
+            'roles': [{'roleid': role_id, 'shortname': f'role{role_id}'} for role_id in role_ids],
+            'groups': [{'id': group_id, 'name': f'group{group_id}'} for group_id in group_ids]
+        }
+
+
+class FakeMySQL:
+    """
+    The sync state and URL tables of the content database, shared by every connection, and
+    MySQL's named locks. Statements are applied as they run, transactions are not modelled.
+    """
+
+    def __init__(self):
+        self.sync_state = {}  # user_id -> [active_generation, pending_generation]
+        self.tables = {'pdf_urls': [], 'discussion_urls': []}  # rows as column -> value dicts
+        self.locks = {}  # lock name -> connection holding it
+        self.writes = []  # statements that changed a URL table
+        self.next_id = 1
+
+    def add_row(self, table, **row):
+        self.tables[table].append(dict(row, id=self.next_id))
+        self.next_id += 1
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+        self.connected = True
+
+    def cursor(self, dictionary=False):
+        return FakeCursor(self)
+
+    def start_transaction(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def is_connected(self):
+        return self.connected
+
+    def close(self):
+        # Like MySQL, closing a session releases its named locks
+        self.database.locks = {name: holder for name, holder in self.database.locks.items() if holder is not self}
+        self.connected = False
+
+
+class FakeCursor:
+    """Runs the statements of populate_database that touch the sync state, the URL tables and the locks,
+    other statements (courses, checkpoints) are accepted and ignored. Rows get an auto-increment id."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.database = connection.database
+        self.result = []
+
+    def execute(self, sql, params=()):
+        statement = ' '.join(sql.split())
+        database, self.result = self.database, []
+        if re.match(r'(INSERT|DELETE|UPDATE)\b.*\b(pdf_urls|discussion_urls)\b', statement):
+            database.writes.append(statement)
+        if statement.startswith('SELECT GET_LOCK'):
+            holder = database.locks.setdefault(params[0], self.connection)
+            self.result = [(1 if holder is self.connection else 0,)]
+        elif statement.startswith('SELECT RELEASE_LOCK'):
+            released = database.locks.get(params[0]) is self.connection
+            if released:
+                del database.locks[params[0]]
+            self.result = [(1 if released else 0,)]
+        elif statement.startswith('SELECT active_generation'):
+            state = database.sync_state.get(params[0])
+            self.result = [tuple(state)] if state else []
+        elif statement.startswith('INSERT INTO content_sync_state'):
+            database.sync_state.setdefault(params[0], [0, None])[1] = params[1]
+        elif statement.startswith('UPDATE content_sync_state'):
+            database.sync_state[params[1]] = [params[0], None]
+        elif match := re.match(r'INSERT IGNORE INTO (pdf_urls|discussion_urls) \((.*?)\) VALUES', statement):
+            columns = match.group(2).split(', ')
+            for start in range(0, len(params), len(columns)):
+                database.add_row(match.group(1), **dict(zip(columns, params[start:start + len(columns)])))
+        elif match := re.match(r'INSERT INTO (pdf_urls|discussion_urls) \((id, .*?)\) VALUES .* ON DUPLICATE KEY UPDATE (.*)', statement):
+            table, columns = match.group(1), match.group(2).split(', ')
+            updated = re.findall(r'(\w+) = VALUES', match.group(3))
+            rows = {row['id']: row for row in database.tables[table]}
+            for start in range(0, len(params), len(columns)):
+                values = dict(zip(columns, params[start:start + len(columns)]))
+                if values['id'] in rows:
+                    rows[values['id']].update({column: values[column] for column in updated})
+                else:
+                    database.tables[table].append(values)
+        elif match := re.match(r'DELETE FROM (pdf_urls|discussion_urls) WHERE id IN', statement):
+            database.tables[match.group(1)] = [row for row in database.tables[match.group(1)] if row['id'] not in params]
+        elif match := re.match(r'DELETE FROM (pdf_urls|discussion_urls) WHERE user_id = %s AND generation (=|<>) %s', statement):
+            table, same = match.group(1), match.group(2) == '='
+            database.tables[table] = [
+                row for row in database.tables[table]
+                if row['user_id'] != params[0] or (row['generation'] == params[1]) != same
+            ]
+        elif match := re.match(r'INSERT INTO (pdf_urls|discussion_urls) \((.*?)\) SELECT .* pending\.(\w+) = active', statement):
+            table, columns, url_column = match.group(1), match.group(2).split(', '), match.group(3)
+            generation, _, user_id, from_generation, *course_ids = params
+            pending_urls = {
+                row[url_column] for row in database.tables[table]
+                if row['user_id'] == user_id and row['generation'] == generation
+            }
+            for row in list(database.tables[table]):
+                if (row['user_id'] == user_id and row['generation'] == from_generation
+                        and row['course_id'] in course_ids and row[url_column] not in pending_urls):
+                    database.add_row(table, **dict({column: row[column] for column in columns}, generation=generation))
+        elif match := re.match(r'SELECT id, (\w+), (course_id, .*?) FROM (\w+) WHERE user_id = %s AND generation = %s', statement):
+            columns = ['id', match.group(1)] + match.group(2).split(', ')
+            self.result = [
+                tuple(row[column] for column in columns) for row in database.tables[match.group(3)]
+                if row['user_id'] == params[0] and row['generation'] == params[1]
+            ]
+        elif match := re.match(r'SELECT (pdf_url|discussion_url) FROM (\w+) WHERE user_id = %s AND generation = %s', statement):
+            self.result = [
+                (row[match.group(1)],) for row in database.tables[match.group(2)]
+                if row['user_id'] == params[0] and row['generation'] == params[1]
+            ]
+
+    def fetchone(self):
+        return self.result.pop(0) if self.result else None
+
+    def fetchall(self):
+        rows, self.result = self.result, []
+        return rows
+
+    def close(self):
+        pass
+
+
+def make_processor(client, moodle_user_id, fetch_cache=None, database=None):
+    processor = ContentProcessor(max_concurrency=2, client=client, fetch_cache=fetch_cache)
+    if database is not None:
+        processor.get_mysql_connection = database.connect
+    processor.token = f'token{moodle_user_id}'
+    processor.user_id = moodle_user_id
+    processor.moodle_user_id = moodle_user_id
+    return processor
+
+
+def course_contents(*file_names, versions=None):
+    """Sections of a course with one resource holding the files, ``versions`` maps a file name to
+    its (timemodified, filesize)"""
+    versions = versions or {}
+    return [{'id': 1, 'modules': [{
+        'id': 1, 'modname': 'resource', 'uservisible': True,
+        'contents': [
+            dict(zip(('timemodified', 'filesize'), versions.get(name, (None, None))),
+                 type='file', filename=name, fileurl=f'https://moodle.test/{name}')
+            for name in file_names
+        ]
+    }]}]
+
+
+def test_roles_and_groups_are_looked_up_with_the_user_token():
+    moodle = FakeMoodle({(7, 1): ([5], [10]), (8, 1): ([5], [11])})
+    fetch_cache = FetchCache()
+    assert make_processor(moodle, 7, fetch_cache)._visibility_key(1) == ((5,), (10,))
+    assert make_processor(moodle, 8, fetch_cache)._visibility_key(1) == ((5,), (11,))
+    assert [(token, params['userlist[0][userid]']) for wsfunction, token, params in moodle.calls] == [
+        ('token7', 7), ('token8', 8)
+    ]
+
+
+def test_course_contents_are_not_shared_across_separate_groups():
+    # User 9 is in no group, users 7 and 8 are in different ones
+    moodle = FakeMoodle(
+        {(9, 1): ([5], []), (7, 1): ([5], [10]), (8, 1): ([5], [11])},
+        {1: course_contents('notes.pdf')}
+    )
+    fetch_cache = FetchCache()
+    for moodle_user_id in (9, 7, 8):
+        make_processor(moodle, moodle_user_id, fetch_cache)._fetch_course_contents(1)
+
+    content_fetches = [token for wsfunction, token, _ in moodle.calls if wsfunction == 'core_course_get_contents']
+    assert content_fetches == ['token9', 'token7', 'token8']
+
+
+def test_course_user_profile_is_requested_one_course_at_a_time():
+    moodle = FakeMoodle({(7, 1): ([5], [10]), (7, 2): ([3], [])})
+    processor = make_processor(moodle, 7, FetchCache())
+
+    # A student of several courses gets the roles and groups of each one
+    assert processor._visibility_key(1) == ((5,), (10,))
+    assert processor._visibility_key(2) == ((3,), ())
+    assert [params for wsfunction, _, params in moodle.calls if wsfunction == 'core_user_get_course_user_profiles'] == [
+        {'userlist[0][userid]': 7, 'userlist[0][courseid]': 1},
+        {'userlist[0][userid]': 7, 'userlist[0][courseid]': 2}
+    ]
+
+
+def test_refused_course_user_profile_is_not_shared():
+    moodle = FakeMoodle({(7, 1): ([5], [10])}, refused=['core_user_get_course_user_profiles'])
+    assert make_processor(moodle, 7, FetchCache())._visibility_key(1) is None
+
+
+def test_visibility_key_of_a_course_without_profile():
+    processor = make_processor(FakeMoodle({}), 7, FetchCache())
+    assert processor._visibility_key(1) is None
+
+
+def test_course_contents_are_shared_by_users_with_the_same_roles_and_groups():
+    moodle = FakeMoodle(
+        {(7, 1): ([5], [10]), (8, 1): ([5], [10]), (9, 1): ([5], [11])},
+        {1: course_contents('notes.pdf')}
+    )
+    fetch_cache = FetchCache()
+    for moodle_user_id in (7, 8, 9):
+        assert make_processor(moodle, moodle_user_id, fetch_cache)._fetch_course_contents(1) == course_contents('notes.pdf')
+
+    content_fetches = [token for wsfunction, token, _ in moodle.calls if wsfunction == 'core_course_get_contents']
+    assert content_fetches == ['token7', 'token9']
+
+
+def test_course_contents_with_per_user_restrictions_are_not_shared():
+    restricted = course_contents('notes.pdf')
+    restricted[0]['modules'].append({
+        'id': 2, 'modname': 'resource', 'uservisible': False, 'contents': [],
+        'availabilityinfo': 'Not available unless: The activity <strong>Quiz 1</strong> is marked complete'
+    })
+    moodle = FakeMoodle({(7, 1): ([5], [10]), (8, 1): ([5], [10]), (9, 1): ([5], [11])}, {1: restricted})
+    fetch_cache = FetchCache()
+    for moodle_user_id in (7, 8, 9):
+        make_processor(moodle, moodle_user_id, fetch_cache)._fetch_course_contents(1)
+
+    # Once the course is known to be restricted, the other users fetch it without a profile lookup
+    assert [(wsfunction, token) for wsfunction, token, _ in moodle.calls] == [
+        ('core_user_get_course_user_profiles', 'token7'), ('core_course_get_contents', 'token7'),
+        ('core_course_get_contents', 'token8'), ('core_course_get_contents', 'token9')
+    ]
+
+
+def test_only_refusals_are_permanent_moodle_errors():
+    def error(errorcode):
+        return MoodleError('core_course_get_contents', {'exception': 'moodle_exception', 'errorcode': errorcode})
+
+    assert not is_transient_error(error('nopermissions'))
+    assert not is_transient_error(error('requireloginerror'))
+    # Database failures on the Moodle side come back as exception payloads with HTTP 200
+    assert is_transient_error(error('dml_read_exception'))
+    assert is_transient_error(error(None))
+
+
+def test_overlapping_atomic_syncs_leave_one_row_per_url():
+    moodle = FakeMoodle({(7, 1): ([5], [])}, {1: course_contents('notes.pdf', 'slides.pdf')})
+    database = FakeMySQL()
+    overlapping = []
+
+    def start_second_sync():
+        # The app starts a sync of the user while the scheduler's one is fetching the course
+        moodle.on_contents = None
+        with pytest.raises(SyncInProgressError):
+            make_processor(moodle, 7, database=database).populate_database(atomic=True)
+        overlapping.append(True)
+
+    moodle.on_contents = start_second_sync
+    make_processor(moodle, 7, database=database).populate_database(atomic=True)
+
+    assert overlapping == [True]
+    assert sorted(row['pdf_url'] for row in database.tables['pdf_urls']) == [
+        'https://moodle.test/notes.pdf&token=token7', 'https://moodle.test/slides.pdf&token=token7'
+    ]
+    assert database.sync_state[7] == [1, None]
+    assert database.locks == {}
+
+
+def test_atomic_sync_activates_despite_a_failing_course():
+    moodle = FakeMoodle(
+        {(7, 1): ([5], []), (7, 2): ([5], [])},
+        {1: course_contents('notes.pdf'),
+         2: MoodleError('core_course_get_contents', {'exception': 'dml_read_exception', 'errorcode': 'dml_read_exception'})}
+    )
+    database = FakeMySQL()
+    database.sync_state[7] = [1, None]
+    database.add_row('pdf_urls', course_id=1, user_id=7, pdf_url='https://moodle.test/removed.pdf',
+                     timemodified=1, filesize=1, generation=1)
+    database.add_row('pdf_urls', course_id=2, user_id=7, pdf_url='https://moodle.test/exam.pdf',
+                     timemodified=1, filesize=1, generation=1)
+
+    failures = make_processor(moodle, 7, database=database).populate_database(atomic=True)
+
+    assert failures == [('contents', 2, 2)]
+    # The failed course keeps its previous rows, the fetched one gets its new ones
+    assert database.sync_state[7] == [2, None]
+    assert sorted((row['course_id'], row['pdf_url'], row['generation']) for row in database.tables['pdf_urls']) == [
+        (1, 'https://moodle.test/notes.pdf&token=token7', 2), (2, 'https://moodle.test/exam.pdf', 2)
+    ]
+
+
+def stored_files(database, course_id, *versions):
+    """Add the pdf_urls rows of a previous sync of user 7, ``versions`` are (file name, timemodified, filesize)"""
+    for name, timemodified, filesize in versions:
+        database.add_row('pdf_urls', course_id=course_id, user_id=7, pdf_url=f'https://moodle.test/{name}&token=token7',
+                         timemodified=timemodified, filesize=filesize, generation=0)
+
+
+def pdf_rows(database):
+    return sorted((row['id'], row['course_id'], row['pdf_url'].split('/')[-1], row['timemodified'], row['filesize'])
+                  for row in database.tables['pdf_urls'])
+
+
+def test_incremental_sync_of_unchanged_content_writes_nothing():
+    database = FakeMySQL()
+    stored_files(database, 1, ('notes.pdf', 100, 10), ('slides.pdf', 200, 20))
+    moodle = FakeMoodle({(7, 1): ([5], [])}, {
+        1: course_contents('notes.pdf', 'slides.pdf', versions={'notes.pdf': (100, 10), 'slides.pdf': (200, 20)})
+    })
+
+    make_processor(moodle, 7, database=database).populate_database(incremental=True)
+
+    assert database.writes == []
+    assert pdf_rows(database) == [
+        (1, 1, 'notes.pdf&token=token7', 100, 10), (2, 1, 'slides.pdf&token=token7', 200, 20)
+    ]
+
+
+def test_incremental_sync_updates_changed_files_in_place():
+    database = FakeMySQL()
+    stored_files(database, 1, ('notes.pdf', 100, 10), ('slides.pdf', 200, 20), ('syllabus.pdf', 300, 30))
+    moodle = FakeMoodle({(7, 1): ([5], [])}, {1: course_contents(
+        'notes.pdf', 'slides.pdf', 'syllabus.pdf', 'lab.pdf',
+        versions={'notes.pdf': (150, 10), 'slides.pdf': (200, 25), 'syllabus.pdf': (300, 30), 'lab.pdf': (400, 40)}
+    )})
+
+    make_processor(moodle, 7, database=database).populate_database(incremental=True)
+
+    # A new timemodified or filesize updates the row under its id, the new file is inserted
+    assert pdf_rows(database) == [
+        (1, 1, 'notes.pdf&token=token7', 150, 10), (2, 1, 'slides.pdf&token=token7', 200, 25),
+        (3, 1, 'syllabus.pdf&token=token7', 300, 30), (4, 1, 'lab.pdf&token=token7', 400, 40)
+    ]
+    assert [statement.split(' (')[0] for statement in database.writes] == [
+        'INSERT IGNORE INTO pdf_urls', 'INSERT INTO pdf_urls'
+    ]
+
+
+def test_incremental_sync_deletes_vanished_rows():
+    database = FakeMySQL()
+    stored_files(database, 1, ('notes.pdf', 100, 10), ('old.pdf', 50, 5))
+    moodle = FakeMoodle({(7, 1): ([5], [])}, {1: course_contents('notes.pdf', versions={'notes.pdf': (100, 10)})})
+
+    make_processor(moodle, 7, database=database).populate_database(incremental=True)
+
+    assert pdf_rows(database) == [(1, 1, 'notes.pdf&token=token7', 100, 10)]
+    assert database.writes == ['DELETE FROM pdf_urls WHERE id IN (%s)']
+
+
+def test_incremental_sync_keeps_rows_of_a_failed_course():
+    database = FakeMySQL()
+    stored_files(database, 1, ('notes.pdf', 100, 10), ('old.pdf', 50, 5))
+    stored_files(database, 2, ('exam.pdf', 100, 10))
+    moodle = FakeMoodle({(7, 1): ([5], []), (7, 2): ([5], [])}, {
+        1: course_contents('notes.pdf', versions={'notes.pdf': (100, 10)}),
+        2: MoodleError('core_course_get_contents', {'exception': 'dml_read_exception', 'errorcode': 'dml_read_exception'})
+    })
+
+    with pytest.raises(SyncIncompleteError):
+        make_processor(moodle, 7, database=database).populate_database(incremental=True)
+
+    # Course 2 was not fetched, so its rows were not seen but are not stale
+    assert pdf_rows(database) == [(1, 1, 'notes.pdf&token=token7', 100, 10), (3, 2, 'exam.pdf&token=token7', 100, 10)]
@@ -0,0 +1,284 @@
+import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import fitz  # PyMuPDF
+from pdf2image import convert_from_path
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+from docx import Document
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+from pptx import Presentation
+from pptx.shapes.group import GroupShape
+
+# An extractor takes a file path and yields (page number, text) pairs, where a "page" is
+# whatever unit the format has: a slide, a top-level section of a document, a form-feed page.
+Extractor = Callable[[str], Iterator[Tuple[int, str]]]
+
+EXTRACTORS: Dict[str, Extractor] = {}
+
+# Pages with less extracted text than this are treated as scanned when images cover most of them
+OCR_MIN_TEXT_CHARS = 20
+# Share of the page area images must cover, so title slides with only a logo are not OCRed
+OCR_MIN_IMAGE_COVERAGE = 0.5
+# PDF text extraction backend: 'pypdf' (LangChain PyPDFLoader) or 'pymupdf'
+PDF_BACKEND = os.getenv('PDF_BACKEND', 'pypdf')
+
+
+def register_extractor(*extensions: str):
+    """Register the decorated function as the text extractor for the given file extensions"""
+    def decorator(extractor: Extractor) -> Extractor:
+        for extension in extensions:
+            EXTRACTORS[extension.lower()] = extractor
+        return extractor
+    return decorator
+
+
+def get_extractor(file_path: str) -> Optional[Extractor]:
+    return EXTRACTORS.get(os.path.splitext(file_path)[1].lower())
+
+
+def extract_pages(file_path: str) -> Iterator[Tuple[int, str]]:
+    """Yield (page number, text) pairs of a file with a registered extractor"""
+    extractor = get_extractor(file_path)
+    if extractor is None:
+        raise ValueError(f"No text extractor registered for: {file_path}")
+    return extractor(file_path)
+
+
+def _table_rows(table) -> List[str]:
+    rows = []
+    for row in table.rows:
+        cells = []
+        for cell in row.cells:
+            text = cell.text.strip()
+            # Merged cells are repeated by python-docx/python-pptx, keep them once
+            if text and (not cells or cells[-1] != text):
+                cells.append(text)
+        if cells:
+            rows.append(' | '.join(cells))
+    return rows
+
+
+@register_extractor('.txt')
+def extract_txt(file_path: str) -> Iterator[Tuple[int, str]]:
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as txt_file:
+        text = txt_file.read()
+    for page_number, page in enumerate(text.split('\f'), start=1):
+        if page.strip():
+            yield page_number, page
+
+
+@register_extractor('.docx')
+def extract_docx(file_path: str) -> Iterator[Tuple[int, str]]:
+    """Yield the document section by section, a new section starting at every Title/Heading 1.
+    Paragraphs and tables are kept in document order, table rows as 'cell | cell' lines."""
+    document = Document(file_path)
+    section_number, blocks = 1, []
+
+    for child in document.element.body.iterchildren():
+        if child.tag.endswith('}p'):
+            paragraph = Paragraph(child, document)
+            text = paragraph.text.strip()
+            if not text:
+                continue
+            style = paragraph.style.name if paragraph.style is not None else ''
+            if style in ('Title', 'Heading 1') and blocks:
+                yield section_number, '\n\n'.join(blocks)
+                section_number, blocks = section_number + 1, []
+            blocks.append(text)
+        elif child.tag.endswith('}tbl'):
+            rows = _table_rows(Table(child, document))
+            if rows:
+                blocks.append('\n'.join(rows))
+
+    if blocks:
+        yield section_number, '\n\n'.join(blocks)
+
+
+def _shape_texts(shapes) -> Iterator[str]:
+    for shape in shapes:
+        # shape_type raises for a shape without preset or custom geometry, so groups are told by class
+        if isinstance(shape, GroupShape):
+            yield from _shape_texts(shape.shapes)
+        elif shape.has_table:
+            rows = _table_rows(shape.table)
+            if rows:
+                yield '\n'.join(rows)
+        elif shape.has_text_frame and shape.text_frame.text.strip():
+            yield shape.text_frame.text.strip()
+
+
+@register_extractor('.pptx')
+def extract_pptx(file_path: str) -> Iterator[Tuple[int, str]]:
+    """Yield one page per slide with its text frames, tables and speaker notes"""
+    presentation = Presentation(file_path)
+    for slide_number, slide in enumerate(presentation.slides, start=1):
+        parts = list(_shape_texts(slide.shapes))
+        if slide.has_notes_slide:
+            # A notes slide without a body placeholder has no notes text frame
+            notes_frame = slide.notes_slide.notes_text_frame
+            notes = notes_frame.text.strip() if notes_frame is not None else ''
+            if notes:
+                parts.append(notes)
+        if parts:
+            yield slide_number, '\n\n'.join(parts)
+
+
+def pdf_page_count(file_path: str) -> int:
+    """Number of pages of a PDF, read from its page tree without extracting any text"""
+    with fitz.open(file_path) as document:
+        return document.page_count
+
+
+def _extract_pdf_range(file_path: str, start: int, stop: int) -> List[Tuple[int, str]]:
+    with fitz.open(file_path) as document:
+        return [(page_index + 1, document[page_index].get_text()) for page_index in range(start, stop)]
+
+
+def extract_pdf_pymupdf(file_path: str, max_workers: Optional[int] = None,
+                        pages_per_range: int = 32) -> Iterator[Tuple[int, str]]:
+    """Yield (page number, text) for every page of a PDF using PyMuPDF.
+    Large PDFs are split into page ranges extracted in parallel processes; pages are still
+    yielded in order, and at most two ranges per worker are extracted ahead of the consumer
+    so memory stays bounded however large the PDF is. Not registered as the '.pdf' extractor,
+    so the PyPDFLoader path stays the default and the two can be compared."""
+    page_count = pdf_page_count(file_path)
+    ranges = [(start, min(start + pages_per_range, page_count)) for start in range(0, page_count, pages_per_range)]
+    max_workers = min(max_workers or os.cpu_count() or 1, len(ranges))
+    # Daemonic ingestion workers cannot start processes of their own
+    if max_workers <= 1 or multiprocessing.current_process().daemon:
+        for start, stop in ranges:
+            yield from _extract_pdf_range(file_path, start, stop)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        pending = deque()
+        for start, stop in ranges:
+            pending.append(executor.submit(_extract_pdf_range, file_path, start, stop))
+            if len(pending) >= 2 * max_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _ocr_page(file_path: str, page_number: int, dpi: int, lang: str) -> str:
+    images = convert_from_path(file_path, dpi=dpi, first_page=page_number, last_page=page_number)
+    return pytesseract.image_to_string(images[0], lang=lang) if images else ''
+
+
+def _is_scanned(page) -> bool:
+    """Whether images cover most of a page, as the full-page scan or the strips of one do"""
+    page_rect = page.rect
+    covered = sum((fitz.Rect(image['bbox']) & page_rect).get_area() for image in page.get_image_info())
+    return covered >= OCR_MIN_IMAGE_COVERAGE * page_rect.get_area()
+
+
+def ocr_time_budget() -> float:
+    """Seconds the OCR of one document may take, at most OCR_PAGE_BUDGET pages OCRed one after the other"""
+    if pytesseract is None:
+        return 0.0
+    return int(os.getenv('OCR_PAGE_BUDGET', '50')) * float(os.getenv('OCR_SECONDS_PER_PAGE', '10'))
+
+
+def ocr_scanned_pages(file_path: str, pages: Iterable[Tuple[int, str]], page_budget: Optional[int] = None,
+                      max_workers: Optional[int] = None, dpi: int = 300,
+                      lang: Optional[str] = None) -> Iterator[Tuple[int, str]]:
+    """Pass a PDF's (page number, text) stream through, replacing the text of scanned pages by OCR.
+    A page is scanned when it has no usable text layer and images cover most of it. At most ``page_budget``
+    pages per document are OCRed, in a background process pool that is only started when the
+    first scanned page shows up, so PDFs with a text layer pay nothing extra. Pages keep their order.
+    A page whose OCR fails (Tesseract or Poppler missing, unreadable page) keeps its extracted text,
+    and the first failure of the document is reported."""
+    page_budget = int(os.getenv('OCR_PAGE_BUDGET', '50')) if page_budget is None else page_budget
+    lang = lang or os.getenv('OCR_LANG', 'eng+tur')
+    if pytesseract is None or page_budget <= 0:
+        yield from pages
+        return
+
+    max_workers = max_workers or os.cpu_count() or 1
+    document, executor = None, None
+    pending = deque()  # (page number, extracted text, OCR text or Future) in page order
+    failures = 0
+
+    def ocr_failed(page_number: int, error: Exception):
+        nonlocal failures
+        failures += 1
+        if failures == 1:
+            print(f"OCR failed on page {page_number} of {file_path}, keeping the extracted text: {str(error)}")
+
+    def page_text(page_number: int, text: str, ocr_text) -> str:
+        if not isinstance(ocr_text, Future):
+            return text if ocr_text is None else ocr_text
+        try:
+            return ocr_text.result()
+        except Exception as e:
+            ocr_failed(page_number, e)
+            return text
+
+    try:
+        for page_number, text in pages:
+            ocr_text = None
+            if len(text.strip()) < OCR_MIN_TEXT_CHARS and page_budget > 0:
+                if document is None:
+                    document = fitz.open(file_path)
+                if _is_scanned(document[page_number - 1]):
+                    page_budget -= 1
+                    if multiprocessing.current_process().daemon:
+                        # Daemonic ingestion workers cannot start processes of their own, so their
+                        # scanned pages are OCRed one after the other; the page budget bounds the time
+                        # and the ingestion pool already keeps every core busy with other files
+                        try:
+                            ocr_text = _ocr_page(file_path, page_number, dpi, lang)
+                        except Exception as e:
+                            ocr_failed(page_number, e)
+                    else:
+                        if executor is None:
+                            executor = ProcessPoolExecutor(max_workers=max_workers,
+                                                           mp_context=multiprocessing.get_context('spawn'))
+                        ocr_text = executor.submit(_ocr_page, file_path, page_number, dpi, lang)
+            pending.append((page_number, text, ocr_text))
+
+            # Emit pages whose text is ready, waiting only when too much OCR work is queued
+            while pending and (not isinstance(pending[0][2], Future) or pending[0][2].done()
+                               or len(pending) > 2 * max_workers):
+                head = pending.popleft()
+                yield head[0], page_text(*head)
+
+        while pending:
+            head = pending.popleft()
+            yield head[0], page_text(*head)
+        if failures > 1:
+            print(f"OCR failed on {failures} pages of {file_path}")
+    finally:
+        if document is not None:
+            document.close()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def load_pages(file_path: str, pdf_backend: Optional[str] = None) -> Iterator[Tuple[int, str]]:
+    """Yield (page number, text) pairs of a document.
+    Formats with a registered extractor (DOCX, PPTX, TXT) are read directly, anything else
+    as PDF with the selected backend ('pypdf' or 'pymupdf', PDF_BACKEND by default),
+    with OCR for scanned pages."""
+    extractor = get_extractor(file_path)
+    if extractor is not None:
+        return extractor(file_path)
+
+    pdf_backend = pdf_backend or PDF_BACKEND
+    if pdf_backend == 'pymupdf':
+        pages = extract_pdf_pymupdf(file_path)
+    elif pdf_backend == 'pypdf':
+        # Imported here, the page range and OCR workers re-import this module and never use it
+        from langchain_community.document_loaders import PyPDFLoader
+        loader = PyPDFLoader(file_path)
+        pages = ((doc.metadata.get('page', index) + 1, doc.page_content) for index, doc in enumerate(loader.lazy_load()))
+    else:
+        raise ValueError(f"Unknown PDF backend: {pdf_backend}")
+    # Scanned pages come back without text, they are recovered by OCR
+    return ocr_scanned_pages(file_path, pages)